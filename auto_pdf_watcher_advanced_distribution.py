@@ -21,7 +21,15 @@ import platform
 import ctypes
 import ctypes.wintypes as wintypes
 import random
+import math
+import hashlib
+import sqlite3
+import tracemalloc
 import statistics as stats
+from collections import deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # ファイル監視用
 from watchdog.observers import Observer
@@ -37,6 +45,7 @@ import io
 import base64
 import anthropic
 import re
+import bisect
 
 class PDFWatcherHandler(FileSystemEventHandler):
     """PDFファイル監視イベントハンドラー"""
@@ -47,8 +56,2009 @@ class PDFWatcherHandler(FileSystemEventHandler):
     def on_created(self, event):
         """新しいファイルが作成されたときの処理"""
         if not event.is_directory and event.src_path.lower().endswith('.pdf'):
-            self.classifier.log_message(f"新しいPDFを検出: {os.path.basename(event.src_path)}")
-            threading.Timer(2.0, self.classifier.process_new_file, args=[event.src_path]).start()
+            self.classifier.watch_new_file(event.src_path)
+
+    def on_moved(self, event):
+        """リネーム/移動（*.tmp → .pdf で書き出すスキャナ対策）"""
+        if event.is_directory:
+            return
+        # 移動元が完了待ちなら取り下げ
+        self.classifier.stability_monitor.discard(event.src_path)
+        if event.dest_path.lower().endswith('.pdf'):
+            self.classifier.watch_new_file(event.dest_path)
+
+    def on_modified(self, event):
+        """書き込み中の変更通知は完了待ちの判定に吸収（単独では新規扱いしない）"""
+        if not event.is_directory and event.src_path.lower().endswith('.pdf'):
+            self.classifier.stability_monitor.touch(event.src_path)
+
+class FileStabilityMonitor:
+    """書き込み完了検出（固定待ちの代わりに、完成したファイルだけを即座に渡す）。
+    - サイズ/更新時刻が連続2回一致するまで待つ（変化中は間隔を伸ばしてポーリング）
+    - 他プロセスが書き込み中でないか（書き込みモードで開けるか）を確認
+    - 末尾に %%EOF があるかを確認（無いPDFも一定時間安定すれば受け入れる）
+    1本のスレッドで全ファイルを監視する。
+    """
+
+    def __init__(self, on_ready, on_timeout=None, min_interval: float = 0.2, max_interval: float = 2.0,
+                 timeout: float = 600.0, eof_grace: float = 10.0):
+        self._on_ready = on_ready
+        self._on_timeout = on_timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.eof_grace = eof_grace
+        self._cond = threading.Condition()
+        self._pending = {}  # path -> 状態dict
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="pdf-stability", daemon=True)
+        self._thread.start()
+
+    def add(self, path: str, priority: str = 'normal') -> bool:
+        """監視対象に追加。既に待機中なら False（同一パスのイベントは1件にまとめる）"""
+        now = time.monotonic()
+        with self._cond:
+            if path in self._pending:
+                return False
+            self._pending[path] = {
+                'first_seen': now,
+                'sig': None,
+                'stable_since': None,
+                'interval': self.min_interval,
+                'next_check': now,
+                'priority': priority,
+            }
+            self._cond.notify_all()
+            return True
+
+    def touch(self, path: str) -> bool:
+        """待機中のファイルに変更通知が来たら、書き込み継続とみなして判定を延ばす"""
+        with self._cond:
+            st = self._pending.get(path)
+            if st is None:
+                return False
+            st['stable_since'] = None
+            st['next_check'] = max(st['next_check'], time.monotonic() + self.min_interval)
+            return True
+
+    def discard(self, path: str):
+        with self._cond:
+            self._pending.pop(path, None)
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.monotonic()
+                    due = [p for p, st in self._pending.items() if st['next_check'] <= now]
+                    if due:
+                        break
+                    if self._pending:
+                        wait = min(st['next_check'] for st in self._pending.values()) - now
+                        self._cond.wait(max(0.01, wait))
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+            for path in due:
+                with self._cond:
+                    st = self._pending.get(path)
+                if st is None:
+                    continue
+                try:
+                    verdict = self._probe(path, st)
+                except Exception:
+                    verdict = 'wait'
+                now = time.monotonic()
+                waited = now - st['first_seen']
+                if verdict == 'wait' and waited > self.timeout:
+                    verdict = 'timeout'
+                if verdict == 'wait':
+                    with self._cond:
+                        if path in self._pending:
+                            st['next_check'] = now + st['interval']
+                    continue
+                with self._cond:
+                    self._pending.pop(path, None)
+                try:
+                    if verdict == 'ready':
+                        self._on_ready(path, waited, st['priority'])
+                    elif verdict == 'timeout' and self._on_timeout:
+                        self._on_timeout(path, waited)
+                except Exception as e:
+                    print(f"完了検出コールバックエラー: {path} - {e}")
+
+    def _probe(self, path: str, st: dict) -> str:
+        """'ready' / 'wait' / 'gone' を返す"""
+        try:
+            s = os.stat(path)
+        except FileNotFoundError:
+            return 'gone'
+        sig = (s.st_size, s.st_mtime_ns)
+        now = time.monotonic()
+        if s.st_size == 0 or sig != st['sig']:
+            # まだ書き込み中：間隔を伸ばして様子を見る
+            if st['sig'] is not None:
+                st['interval'] = min(self.max_interval, st['interval'] * 1.5)
+            st['sig'] = sig
+            st['stable_since'] = None
+            return 'wait'
+        if st['stable_since'] is None:
+            st['stable_since'] = now
+        # 書き込み中のプロセスがファイルを掴んでいないか
+        if os.access(path, os.W_OK):
+            try:
+                fd = os.open(path, os.O_RDWR)
+                os.close(fd)
+            except OSError:
+                st['stable_since'] = None
+                return 'wait'
+        # PDF末尾の %%EOF を確認
+        try:
+            with open(path, 'rb') as f:
+                f.seek(max(0, s.st_size - 2048))
+                tail = f.read()
+        except OSError:
+            return 'wait'
+        if b'%%EOF' in tail:
+            return 'ready'
+        if now - st['stable_since'] >= self.eof_grace:
+            return 'ready'
+        return 'wait'
+
+class PDFJobQueue:
+    """処理待ちPDFの有界キュー + 固定数ワーカー（フォルダ間で公平に配分）。
+    - 投入はキュー容量までで、満杯時は submit 側が待たされる（バックプレッシャー）
+    - 同時に処理するファイル数はワーカー数まで、さらにフォルダごとの上限（max_concurrency）
+    - フォルダごとの列を重み（priority）付きラウンドロビンで取り出す
+    - 待ち行列が空のフォルダに届いた1件は「対話レーン」に入り、大量投入分より先に処理
+    - priority='low'（起動時の取りこぼし回収など）は他に仕事が無いときだけ処理
+    - 同一パスの二重投入は無視
+    policy(folder) は (重み, 同時処理上限 or 0) を返す（設定変更を即時反映するため毎回参照）。
+    """
+
+    def __init__(self, worker_func, workers: int, capacity: int, on_change=None, policy=None):
+        self._worker_func = worker_func
+        self.workers = max(1, int(workers))
+        self.capacity = max(1, int(capacity))
+        self._on_change = on_change
+        self._policy = policy or (lambda folder: (1, 0))
+        self._cond = threading.Condition()
+        self._interactive = deque()  # (ready_at, path, folder)
+        self._lanes = {}  # folder -> deque[(ready_at, path)]
+        self._low_lanes = {}  # folder -> deque[(ready_at, path)]
+        self._credit = {}  # 重み付きラウンドロビンの持ち点
+        self._running = {}  # folder -> 処理中件数
+        self._size = 0
+        self._paths = set()  # 待機中 + 処理中のパス
+        self._in_flight = 0
+        self._stopped = False
+        self._threads = []
+
+    def start(self):
+        """ワーカースレッドを起動"""
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker_loop, name=f"pdf-worker-{i+1}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """新規取り出しを止める（処理中のファイルは最後まで実行）"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def depth(self) -> tuple[int, int]:
+        """(待機数, 処理中数)"""
+        with self._cond:
+            return self._size, self._in_flight
+
+    def is_full(self) -> bool:
+        with self._cond:
+            return self._size >= self.capacity
+
+    def submit(self, path: str, delay: float = 0.0, timeout: float | None = None,
+               priority: str = 'normal', folder: str = '') -> bool:
+        """パスを投入。満杯なら空きが出るまで待つ。timeout切れ/停止時は False。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if path in self._paths:
+                return True
+            while self._size >= self.capacity and not self._stopped:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            if self._stopped:
+                return False
+            ready_at = time.monotonic() + max(0.0, delay)
+            if priority == 'low':
+                self._low_lanes.setdefault(folder, deque()).append((ready_at, path))
+            elif not self._lanes.get(folder) and not any(f == folder for _, _, f in self._interactive):
+                # そのフォルダに待ちが無い単発の1件 → 対話レーン
+                self._interactive.append((ready_at, path, folder))
+            else:
+                self._lanes.setdefault(folder, deque()).append((ready_at, path))
+            self._size += 1
+            self._paths.add(path)
+            self._cond.notify_all()
+        self._notify_change()
+        return True
+
+    def _under_cap(self, folder) -> bool:
+        try:
+            cap = int(self._policy(folder)[1] or 0)
+        except Exception:
+            cap = 0
+        return cap <= 0 or self._running.get(folder, 0) < cap
+
+    def _pick_weighted(self, lanes: dict, now: float):
+        """重み付きラウンドロビン（smooth WRR）で1件取り出す"""
+        eligible = []
+        for folder, q in lanes.items():
+            if q and q[0][0] <= now and self._under_cap(folder):
+                try:
+                    weight = max(1, int(self._policy(folder)[0]))
+                except Exception:
+                    weight = 1
+                eligible.append((folder, weight))
+        if not eligible:
+            return None
+        total = 0
+        best = None
+        for folder, weight in eligible:
+            self._credit[folder] = self._credit.get(folder, 0) + weight
+            total += weight
+            if best is None or self._credit[folder] > self._credit[best]:
+                best = folder
+        self._credit[best] -= total
+        q = lanes[best]
+        _, path = q.popleft()
+        if not q:
+            del lanes[best]
+            self._credit.pop(best, None)
+        return path, best
+
+    def _pick(self):
+        now = time.monotonic()
+        for i, (ready_at, path, folder) in enumerate(self._interactive):
+            if ready_at <= now and self._under_cap(folder):
+                del self._interactive[i]
+                return path, folder
+        return self._pick_weighted(self._lanes, now) or self._pick_weighted(self._low_lanes, now)
+
+    def _next_ready_at(self):
+        heads = [r for r, _, _ in self._interactive]
+        for lanes in (self._lanes, self._low_lanes):
+            heads.extend(q[0][0] for q in lanes.values() if q)
+        return min(heads) if heads else None
+
+    def _next_job(self):
+        with self._cond:
+            while not self._stopped:
+                picked = self._pick() if self._size else None
+                if picked is None:
+                    # 待ちが無い / 準備前 / 上限到達 → 投入か完了を待つ
+                    nxt = self._next_ready_at()
+                    now = time.monotonic()
+                    self._cond.wait(None if nxt is None or nxt <= now else nxt - now)
+                    continue
+                path, folder = picked
+                self._size -= 1
+                self._in_flight += 1
+                self._running[folder] = self._running.get(folder, 0) + 1
+                # 空きができたので submit 待ちを起こす
+                self._cond.notify_all()
+                return path, folder
+            return None
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            path, folder = job
+            self._notify_change()
+            try:
+                self._worker_func(path)
+            except Exception as e:
+                print(f"ワーカー処理エラー: {path} - {e}")
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._running[folder] -= 1
+                    if not self._running[folder]:
+                        del self._running[folder]
+                    self._paths.discard(path)
+                    self._cond.notify_all()
+                self._notify_change()
+
+    def _notify_change(self):
+        try:
+            if self._on_change:
+                self._on_change()
+        except Exception:
+            pass
+
+class APIRateLimiter:
+    """Claude API 呼び出しの共有レート制限（トークンバケット）。
+    リクエスト数/入力トークン/出力トークン（いずれも毎分）の3つのバケットを持ち、
+    送信前に見積もり分を確保できるまで呼び出し側を到着順に待たせる。
+    応答後は実際の使用量（usage）との差分を精算する。
+    """
+
+    # APIの画像縮小ルール（長辺1568px・約1.15MPを超えると縮小され、トークン≒幅×高さ/750）
+    IMAGE_MAX_EDGE = 1568
+    IMAGE_MAX_PIXELS = 1_150_000
+
+    def __init__(self, requests_per_minute: int, input_tokens_per_minute: int, output_tokens_per_minute: int):
+        self._cond = threading.Condition()
+        self._tickets = deque()
+        self._next_ticket = 0
+        self._paused_until = 0.0
+        self._buckets = {}
+        self.set_limits(requests_per_minute, input_tokens_per_minute, output_tokens_per_minute)
+
+    def set_limits(self, requests_per_minute, input_tokens_per_minute, output_tokens_per_minute):
+        now = time.monotonic()
+        with self._cond:
+            for name, limit in (('requests', requests_per_minute), ('input', input_tokens_per_minute),
+                                ('output', output_tokens_per_minute)):
+                cap = max(1.0, float(limit))
+                old = self._buckets.get(name)
+                level = min(cap, old['level']) if old else cap
+                self._buckets[name] = {'cap': cap, 'rate': cap / 60.0, 'level': level, 'ts': now}
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        for b in self._buckets.values():
+            b['level'] = min(b['cap'], b['level'] + (now - b['ts']) * b['rate'])
+            b['ts'] = now
+
+    def acquire(self, input_tokens: int, output_tokens: int) -> float:
+        """見積もり分を確保（不足なら補充まで待つ）。待った秒数を返す。"""
+        started = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._tickets.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    need = {
+                        'requests': 1.0,
+                        'input': min(float(input_tokens), self._buckets['input']['cap']),
+                        'output': min(float(output_tokens), self._buckets['output']['cap']),
+                    }
+                    wait = self._paused_until - now
+                    if self._tickets[0] == ticket:
+                        for name, amount in need.items():
+                            b = self._buckets[name]
+                            if b['level'] < amount:
+                                wait = max(wait, (amount - b['level']) / b['rate'])
+                        if wait <= 0:
+                            for name, amount in need.items():
+                                self._buckets[name]['level'] -= amount
+                            return time.monotonic() - started
+                    # 先頭でなければ順番が来るまで、先頭なら補充を待つ
+                    self._cond.wait(wait if wait > 0 else None)
+            finally:
+                self._tickets.remove(ticket)
+                self._cond.notify_all()
+
+    def settle(self, est_input: int, est_output: int, actual_input: int | None, actual_output: int | None):
+        """見積もりと実使用量の差を精算（多く確保した分は返却、不足分は追加で差し引く）"""
+        with self._cond:
+            self._refill(time.monotonic())
+            for name, est, actual in (('input', est_input, actual_input), ('output', est_output, actual_output)):
+                if actual is None:
+                    continue
+                b = self._buckets[name]
+                b['level'] = min(b['cap'], b['level'] + (min(est, b['cap']) - actual))
+            self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        """429等を受けたとき、全呼び出しを一定時間止める"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + max(0.0, seconds))
+            self._cond.notify_all()
+
+    @staticmethod
+    def estimate_text_tokens(text: str) -> int:
+        """日本語は1文字≒1トークン、ASCIIは約3.5文字≒1トークンとして控えめに見積もる"""
+        if not text:
+            return 0
+        ascii_count = sum(1 for ch in text if ord(ch) < 128)
+        return int((len(text) - ascii_count) + ascii_count / 3.5) + 1
+
+    @classmethod
+    def estimate_image_tokens(cls, width: int, height: int) -> int:
+        scale = min(1.0, cls.IMAGE_MAX_EDGE / max(width, height, 1))
+        w, h = width * scale, height * scale
+        if w * h > cls.IMAGE_MAX_PIXELS:
+            r = (cls.IMAGE_MAX_PIXELS / (w * h)) ** 0.5
+            w, h = w * r, h * r
+        return int(w * h / 750) + 1
+
+    @classmethod
+    def image_scale_for_budget(cls, width: float, height: float, token_budget: int,
+                               max_scale: float = 2.0) -> float:
+        """width×height（ポイント）のページを token_budget 以内に収めるレンダリング倍率。
+        APIが縮小してしまう大きさ（長辺1568px・約1.15MP）を超えないようにも制限する。
+        """
+        width, height = max(width, 1.0), max(height, 1.0)
+        pixels = min(max(token_budget, 1) * 750, cls.IMAGE_MAX_PIXELS)
+        scale = min(max_scale,
+                    cls.IMAGE_MAX_EDGE / max(width, height),
+                    (pixels / (width * height)) ** 0.5)
+        return max(scale, 0.1)
+
+    @classmethod
+    def estimate_content_tokens(cls, content_blocks) -> int:
+        """メッセージ内容（テキスト/画像ブロック）の入力トークンを送信前に見積もる"""
+        total = 10
+        for block in content_blocks or []:
+            try:
+                if block.get('type') == 'text':
+                    total += cls.estimate_text_tokens(block.get('text') or '')
+                elif block.get('type') == 'image':
+                    data = block.get('source', {}).get('data') or ''
+                    # 画像サイズはヘッダだけ読めば分かるので先頭のみデコード
+                    head = data[:65536]
+                    head = head[:len(head) - len(head) % 4]
+                    with Image.open(io.BytesIO(base64.b64decode(head))) as im:
+                        total += cls.estimate_image_tokens(*im.size)
+            except Exception:
+                total += 1600
+        return total
+
+class JobJournal:
+    """処理中ジョブの永続ジャーナル（SQLite WAL）。
+    状態: queued / rendering / classifying / renaming / done / failed
+    record() はメモリ上の一覧に積むだけで、書き込みは専用スレッドがまとめて1トランザクションで行う
+    （1ファイルあたりの記録コストを1ms未満に抑えるため）。
+    起動時に未完了（done/failed以外）のジョブを取り出して再開に使う。
+    """
+
+    FINISHED = ('done', 'failed')
+
+    def __init__(self, db_path: str, flush_interval: float = 0.2, batch_size: int = 500):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._stopped = False
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' path TEXT PRIMARY KEY, state TEXT NOT NULL, priority TEXT, folder TEXT,'
+                ' created REAL, updated REAL, new_path TEXT, error TEXT, attempts INTEGER DEFAULT 0)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state)')
+        self._thread = threading.Thread(target=self._writer_loop, name="pdf-journal", daemon=True)
+        self._thread.start()
+
+    def record(self, path: str, state: str, priority: str | None = None, folder: str | None = None,
+               new_path: str | None = None, error: str | None = None):
+        with self._cond:
+            self._buffer.append((path, state, priority, folder, time.time(), new_path, error))
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def unfinished(self) -> list[tuple]:
+        """未完了ジョブ [(path, state, priority, folder, attempts)]（登録順）"""
+        self.flush()
+        with self._db_lock:
+            cur = self._conn.execute(
+                'SELECT path, state, priority, folder, attempts FROM jobs WHERE state NOT IN (?, ?) ORDER BY created',
+                self.FINISHED
+            )
+            return cur.fetchall()
+
+    def prune(self, days: float = 7.0):
+        """完了済みの古い記録を削除"""
+        cutoff = time.time() - days * 86400
+        with self._db_lock:
+            self._conn.execute('DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?', self.FINISHED + (cutoff,))
+
+    def flush(self):
+        # 取り出しと書き込みを同じロックの中で行う（同時に flush されても古い状態が新しい状態を上書きしない）
+        with self._db_lock:
+            with self._cond:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            try:
+                self._conn.execute('BEGIN')
+                self._conn.executemany(
+                    'INSERT INTO jobs (path, state, priority, folder, created, updated, new_path, error, attempts)'
+                    ' VALUES (?1, ?2, ?3, ?4, ?5, ?5, ?6, ?7, ?2 = \'rendering\')'
+                    ' ON CONFLICT(path) DO UPDATE SET state=excluded.state, updated=excluded.updated,'
+                    ' priority=COALESCE(excluded.priority, jobs.priority),'
+                    ' folder=COALESCE(excluded.folder, jobs.folder),'
+                    ' created=CASE WHEN excluded.state=\'queued\' THEN excluded.created ELSE jobs.created END,'
+                    ' new_path=excluded.new_path, error=excluded.error,'
+                    # 完了/失敗済みの行に新しいジョブが入ったら試行回数を数え直す（同名ファイルの再利用）
+                    ' attempts=CASE WHEN excluded.state = \'queued\' AND jobs.state IN (\'done\', \'failed\')'
+                    ' THEN 0 ELSE jobs.attempts + (excluded.state = \'rendering\') END',
+                    batch
+                )
+                self._conn.execute('COMMIT')
+            except Exception as e:
+                print(f"ジャーナル書き込みエラー: {e}")
+                try:
+                    self._conn.execute('ROLLBACK')
+                except Exception:
+                    pass
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self.flush()
+        try:
+            with self._db_lock:
+                self._conn.close()
+        except Exception:
+            pass
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                if not self._stopped and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self._stopped:
+                    return
+            self.flush()
+
+class IncrementalTreeScanner:
+    """ディレクトリの更新時刻をキャッシュし、変化したディレクトリだけ一覧を取り直す走査。
+    ファイルの追加/削除/リネームで親ディレクトリの更新時刻が変わることを利用する。
+    dirs: {ディレクトリ: [mtime_ns, [サブディレクトリ...]]}（JSONにそのまま保存できる形）
+    読めなかったディレクトリ（NASの一時的な切断など）はキャッシュを保ったまま扱い、消えたとはみなさない。
+    消えたと判断するのは、親の一覧を取り直せてそこに無かった場合だけ。
+    """
+
+    # 更新時刻の分解能が粗い共有フォルダ向け：直近に更新されたディレクトリは次回も取り直す
+    RACY_NS = 2_000_000_000
+
+    def __init__(self, root: str, dirs: dict | None = None, suffix: str = '.pdf'):
+        self.root = os.path.normpath(root)
+        self.dirs = dirs if dirs is not None else {}
+        self.suffix = suffix
+
+    def scan(self):
+        """(変化したディレクトリの [(dir, {name: (size, mtime_ns) or None})], 消えたディレクトリ一覧) を返す。
+        一覧中の None は、そのファイルの情報を今回読めなかったこと（前回の記録を保つべきこと）を表す。
+        """
+        changed = []
+        seen = set()
+        stack = [self.root]
+        while stack:
+            d = stack.pop()
+            cached = self.dirs.get(d)
+            try:
+                dir_mtime = os.stat(d).st_mtime_ns
+            except OSError:
+                self._keep_cached(d, seen)
+                continue
+            seen.add(d)
+            if cached and cached[0] == dir_mtime:
+                # 変化なし：一覧は取り直さずサブディレクトリだけ辿る
+                stack.extend(cached[1])
+                continue
+            subdirs = []
+            listing = {}
+            partial = False
+            try:
+                with os.scandir(d) as it:
+                    for e in it:
+                        try:
+                            if e.is_dir(follow_symlinks=False):
+                                subdirs.append(e.path)
+                                continue
+                            if not e.name.lower().endswith(self.suffix):
+                                continue
+                            es = e.stat()
+                        except OSError:
+                            # 一時的に読めない項目: 既知のサブディレクトリは辿り、ファイルは前回の記録を保つ
+                            partial = True
+                            if cached and e.path in cached[1]:
+                                subdirs.append(e.path)
+                            elif e.name.lower().endswith(self.suffix):
+                                listing[e.name] = None
+                            continue
+                        listing[e.name] = (es.st_size, es.st_mtime_ns)
+            except OSError:
+                self._keep_cached(d, seen)
+                continue
+            racy = time.time_ns() - dir_mtime < self.RACY_NS
+            # 読めない項目があった場合は次回も取り直す
+            self.dirs[d] = [None if racy or partial else dir_mtime, subdirs]
+            changed.append((d, listing))
+            stack.extend(subdirs)
+        removed = [d for d in self.dirs if d not in seen]
+        for d in removed:
+            self.dirs.pop(d, None)
+        return changed, removed
+
+    def _keep_cached(self, d, seen):
+        """読めなかったディレクトリとキャッシュ上の配下を、変化なし・存在するものとして扱う"""
+        stack = [d]
+        while stack:
+            d = stack.pop()
+            if d in seen:
+                continue
+            seen.add(d)
+            cached = self.dirs.get(d)
+            if cached:
+                stack.extend(cached[1])
+
+
+class FolderManifest:
+    """監視フォルダ内PDFの台帳（取りこぼし回収用、AppDataにJSONで永続化）。
+    - files: {ディレクトリ: {ファイル名: [size, mtime_ns, processed, 失敗回数, 再投入可能な時刻]}}
+      （後ろ2つは処理に失敗したファイルのみ。ファイルが更新されると消える）
+    - dirs:  IncrementalTreeScanner のキャッシュ
+    2回目以降の走査は変化したディレクトリ分のコストで済む。
+    """
+
+    # 処理に失敗し続けるファイルは、失敗ごとに再投入までの待ちを倍にし、上限回数で諦める
+    MAX_FAILURES = 3
+    RETRY_BASE_SECONDS = 600
+    RETRY_MAX_SECONDS = 86400
+
+    def __init__(self, root: str, store_path: str):
+        self.root = os.path.normpath(root)
+        self.store_path = store_path
+        self.files = {}
+        self.scanner = IncrementalTreeScanner(self.root)
+        self.unprocessed = set()
+        self.has_baseline = False
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        try:
+            with open(self.store_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            self.scanner.dirs = data.get('dirs', {})
+            self.unprocessed = {
+                os.path.join(d, n) for d, names in self.files.items() for n, rec in names.items() if not rec[2]
+            }
+            self.has_baseline = True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"台帳読み込みエラー: {self.store_path} - {e}")
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {'root': self.root, 'dirs': self.scanner.dirs, 'files': self.files}
+            data = json.dumps(data, ensure_ascii=False)
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+            tmp = self.store_path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp, self.store_path)
+        except Exception as e:
+            print(f"台帳保存エラー: {self.store_path} - {e}")
+
+    def scan(self) -> list[str]:
+        """差分走査して未処理PDFのパス一覧を返す。
+        初回（台帳なし）は既存ファイルをすべて処理済みとして登録するだけ。
+        """
+        with self.lock:
+            baseline = not self.has_baseline
+            changed, removed = self.scanner.scan()
+            for d, listing in changed:
+                old = self.files.get(d, {})
+                names = {}
+                for n, sig in listing.items():
+                    rec = old.get(n)
+                    if sig is None:
+                        # 今回は読めなかった: 前回の記録（処理済みかどうか）を保つ
+                        if rec:
+                            names[n] = rec
+                        continue
+                    names[n] = [sig[0], sig[1], rec[2] if rec else baseline]
+                    if rec and len(rec) > 3 and rec[0] == sig[0] and rec[1] == sig[1]:
+                        # 内容が変わっていなければ失敗の記録を引き継ぐ
+                        names[n] += rec[3:5]
+                for n in old.keys() - names.keys():
+                    self.unprocessed.discard(os.path.join(d, n))
+                for n, rec in names.items():
+                    if not rec[2]:
+                        self.unprocessed.add(os.path.join(d, n))
+                if names:
+                    self.files[d] = names
+                else:
+                    self.files.pop(d, None)
+            for d in removed:
+                for n in self.files.pop(d, {}):
+                    self.unprocessed.discard(os.path.join(d, n))
+            if changed or removed:
+                self.dirty = True
+            self.has_baseline = True
+            now = time.time()
+            due = []
+            for path in sorted(self.unprocessed):
+                d, n = os.path.split(path)
+                rec = self.files.get(d, {}).get(n)
+                if rec and len(rec) > 3 and (rec[3] >= self.MAX_FAILURES or rec[4] > now):
+                    continue
+                due.append(path)
+            return due
+
+    def is_processed(self, path: str) -> bool:
+        d, n = os.path.split(os.path.normpath(path))
+        with self.lock:
+            rec = self.files.get(d, {}).get(n)
+            return bool(rec and rec[2])
+
+    def mark(self, path: str, processed: bool = True):
+        """ファイルの状態を記録（存在しなければ台帳から外す）"""
+        path = os.path.normpath(path)
+        d, n = os.path.split(path)
+        with self.lock:
+            try:
+                st = os.stat(path)
+            except OSError:
+                names = self.files.get(d)
+                if names and names.pop(n, None) is not None:
+                    if not names:
+                        self.files.pop(d, None)
+                    self.dirty = True
+                self.unprocessed.discard(path)
+                return
+            self.files.setdefault(d, {})[n] = [st.st_size, st.st_mtime_ns, processed]
+            if processed:
+                self.unprocessed.discard(path)
+            else:
+                self.unprocessed.add(path)
+            self.dirty = True
+
+    def mark_failed(self, path: str) -> int:
+        """処理失敗を記録し、（内容が変わらないままの）通算失敗回数を返す。ファイルが無ければ 0"""
+        path = os.path.normpath(path)
+        d, n = os.path.split(path)
+        with self.lock:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return 0
+            rec = self.files.get(d, {}).get(n)
+            failures = 1
+            if rec and len(rec) > 3 and rec[0] == st.st_size and rec[1] == st.st_mtime_ns:
+                failures = rec[3] + 1
+            delay = min(self.RETRY_MAX_SECONDS, self.RETRY_BASE_SECONDS * 2 ** (failures - 1))
+            self.files.setdefault(d, {})[n] = [st.st_size, st.st_mtime_ns, False, failures, time.time() + delay]
+            self.unprocessed.add(path)
+            self.dirty = True
+            return failures
+
+    def contains(self, path: str) -> bool:
+        p = os.path.normcase(os.path.normpath(path))
+        r = os.path.normcase(self.root)
+        return p == r or p.startswith(r.rstrip(os.sep) + os.sep)
+
+class PollingFolderWatcher:
+    """ポーリング方式の監視（変更通知が不安定なNAS/ネットワーク共有向け）。
+    1本のスレッドで対象フォルダを巡回し、前回スナップショットとの差分で新規/更新PDFを通知する。
+    """
+
+    def __init__(self, on_new_file, on_changed_file=None):
+        self._on_new_file = on_new_file
+        self._on_changed_file = on_changed_file
+        self._cond = threading.Condition()
+        self._entries = {}  # path -> 状態dict
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="pdf-polling", daemon=True)
+        self._thread.start()
+
+    def add(self, path: str, interval: float):
+        with self._cond:
+            entry = self._entries.get(path)
+            if entry:
+                entry['interval'] = interval
+                return
+            self._entries[path] = {
+                'scanner': IncrementalTreeScanner(path),
+                'files': {},  # dir -> {name: (size, mtime_ns)}
+                'interval': interval,
+                'next': time.monotonic(),
+                'primed': False,
+            }
+            self._cond.notify_all()
+
+    def remove(self, path: str):
+        with self._cond:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        with self._cond:
+            self._entries.clear()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.monotonic()
+                    due = [(p, e) for p, e in self._entries.items() if e['next'] <= now]
+                    if due:
+                        break
+                    if self._entries:
+                        self._cond.wait(max(0.05, min(e['next'] for e in self._entries.values()) - now))
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+            for path, entry in due:
+                try:
+                    self._poll(entry)
+                except Exception as e:
+                    print(f"ポーリング監視エラー: {path} - {e}")
+                entry['next'] = time.monotonic() + entry['interval']
+
+    def _poll(self, entry):
+        changed, removed = entry['scanner'].scan()
+        files = entry['files']
+        found, modified = [], []
+        for d, listing in changed:
+            old = files.get(d, {})
+            current = {}
+            for n, sig in listing.items():
+                prev = old.get(n)
+                if sig is None:
+                    # 今回は読めなかった: 前回の状態を保つ
+                    if prev is not None:
+                        current[n] = prev
+                    continue
+                current[n] = sig
+                if prev is None:
+                    found.append(os.path.join(d, n))
+                elif prev != sig:
+                    modified.append(os.path.join(d, n))
+            files[d] = current
+        for d in removed:
+            files.pop(d, None)
+        # 初回は既存ファイルの把握のみ（停止中の分は取りこぼし回収が担当）
+        if not entry['primed']:
+            entry['primed'] = True
+            return
+        for p in found:
+            self._on_new_file(p)
+        if self._on_changed_file:
+            for p in modified:
+                self._on_changed_file(p)
+
+class FolderSettingsIndex:
+    """ファイルパス → 監視フォルダ設定の最長一致検索。
+    パス要素ごとのトライ木で、最も深い（具体的な）登録フォルダの設定を O(階層数) で返す。
+    Windowsでは normcase により大文字小文字を区別しない。
+    """
+
+    def __init__(self, folders=None):
+        self._lock = threading.Lock()
+        self._root = {'c': {}, 's': None}
+        if folders:
+            self.rebuild(folders)
+
+    @staticmethod
+    def _parts(path: str) -> list[str]:
+        p = os.path.normcase(os.path.normpath(os.path.abspath(path)))
+        return [x for x in p.split(os.sep) if x]
+
+    def rebuild(self, folders):
+        root = {'c': {}, 's': None}
+        for info in folders:
+            self._insert(root, info)
+        with self._lock:
+            self._root = root
+
+    def add(self, folder_info):
+        """登録（同じパスなら設定を差し替え）"""
+        with self._lock:
+            self._insert(self._root, folder_info)
+
+    def _insert(self, root, folder_info):
+        node = root
+        for part in self._parts(folder_info.get('path', '')):
+            node = node['c'].setdefault(part, {'c': {}, 's': None})
+        node['s'] = folder_info
+
+    def remove(self, folder_path: str):
+        with self._lock:
+            trail = [self._root]
+            parts = self._parts(folder_path)
+            for part in parts:
+                nxt = trail[-1]['c'].get(part)
+                if nxt is None:
+                    return
+                trail.append(nxt)
+            trail[-1]['s'] = None
+            # 不要になった枝を刈る
+            for i in range(len(parts), 0, -1):
+                node = trail[i]
+                if node['s'] is None and not node['c']:
+                    del trail[i - 1]['c'][parts[i - 1]]
+                else:
+                    break
+
+    def clear(self):
+        with self._lock:
+            self._root = {'c': {}, 's': None}
+
+    def lookup(self, path: str):
+        """path を含む最も深い登録フォルダの設定（無ければ None）"""
+        with self._lock:
+            node = self._root
+            best = node['s']
+            for part in self._parts(path):
+                node = node['c'].get(part)
+                if node is None:
+                    break
+                if node['s'] is not None:
+                    best = node['s']
+            return best
+
+class ParsedDocument:
+    """1ジョブ分のPDFを一度だけ開いて各処理段で共有する。
+    ファイルはメモリに一括で読み込んでから解析するため、ネットワーク共有でも読み取りは1回、
+    処理中にファイルハンドルを握らないのでリネームも妨げない。
+    ページのスパン表（本文テキストとレイアウトの両方の元）・レンダリング結果は初回要求時に作ってキャッシュする。
+    """
+
+    def __init__(self, path: str, farm=None, governor=None, data: bytes | None = None):
+        """data: 読み込み済みのファイル内容（RenderFarm のワーカーが親から受け取る場合。None ならファイルを読む）"""
+        self.path = path
+        # 画像エンコードを別プロセスに任せる場合の RenderFarm（None ならこのプロセスで実行）
+        self.farm = farm
+        # 画像バッファのメモリ予算（MemoryGovernor）。このジョブが確保中のバイト数とその最大値
+        self.governor = governor
+        self.reserved_bytes = 0
+        self.peak_reserved_bytes = 0
+        self._pix_bytes = {}
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        self._data = data
+        # RenderFarm のワーカーが開いた文書を使い回すための識別子
+        self.token = os.urandom(8).hex()
+        self._doc = fitz.open(stream=self._data, filetype='pdf')
+        self._spans = {}
+        self._texts = {}
+        self._lines = {}
+        # extract_layout_title の結果（None=未計算、''=タイトルなし）
+        self.layout_title_cache = None
+        self._pixmaps = {}
+        self._payloads = {}
+        self._mono = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @property
+    def page_count(self) -> int:
+        return len(self._doc) if self._doc is not None else 0
+
+    def page(self, index: int):
+        return self._doc[index]
+
+    # スパン表の列: (ブロック番号, 行番号, テキスト, x0, y0, x1, y1, フォントサイズ, フラグ)
+    SPAN_BLOCK, SPAN_LINE, SPAN_TEXT, SPAN_X0, SPAN_Y0, SPAN_X1, SPAN_Y1, SPAN_SIZE, SPAN_FLAGS = range(9)
+
+    def spans(self, index: int) -> list[tuple]:
+        """ページのスパン表（get_text('dict') を1回だけ走査して作る。画像ブロックは取得しない）"""
+        if index not in self._spans:
+            info = self._doc[index].get_text('dict', flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES)
+            table = []
+            for b_no, block in enumerate(info.get('blocks', [])):
+                for l_no, line in enumerate(block.get('lines', []) or []):
+                    for span in line.get('spans', []) or []:
+                        x0, y0, x1, y1 = span.get('bbox') or (0.0, 0.0, 0.0, 0.0)
+                        table.append((b_no, l_no, span.get('text') or '', x0, y0, x1, y1,
+                                      float(span.get('size') or 0), int(span.get('flags') or 0)))
+            self._spans[index] = table
+        return self._spans[index]
+
+    def page_text(self, index: int) -> str:
+        """スパン表から組み立てたプレーンテキスト（1行ごとに改行）"""
+        if index not in self._texts:
+            out, parts, current = [], [], None
+            for span in self.spans(index):
+                key = (span[self.SPAN_BLOCK], span[self.SPAN_LINE])
+                if key != current:
+                    if current is not None:
+                        out.append(''.join(parts))
+                    parts, current = [], key
+                parts.append(span[self.SPAN_TEXT])
+            if current is not None:
+                out.append(''.join(parts))
+            self._texts[index] = ''.join(line + '\n' for line in out)
+        return self._texts[index]
+
+    def page_lines(self, index: int) -> list[tuple]:
+        """空白以外のスパンを行ごとにまとめた [(y0, y1, 最大フォントサイズ, テキスト, x0, x1, フラグ)]
+        （テキスト層が無ければ空）。フラグは行内スパンのフラグの論理和。
+        """
+        if index not in self._lines:
+            lines, current, acc = [], None, None
+            for span in self.spans(index):
+                text = span[self.SPAN_TEXT]
+                if not text.strip():
+                    continue
+                key = (span[self.SPAN_BLOCK], span[self.SPAN_LINE])
+                if key != current:
+                    if acc is not None:
+                        lines.append((acc[0], acc[1], acc[2], ''.join(acc[3]).strip(), acc[4], acc[5], acc[6]))
+                    current = key
+                    acc = [span[self.SPAN_Y0], span[self.SPAN_Y1], span[self.SPAN_SIZE], [],
+                           span[self.SPAN_X0], span[self.SPAN_X1], span[self.SPAN_FLAGS]]
+                else:
+                    acc[0] = min(acc[0], span[self.SPAN_Y0])
+                    acc[1] = max(acc[1], span[self.SPAN_Y1])
+                    acc[2] = max(acc[2], span[self.SPAN_SIZE])
+                    acc[4] = min(acc[4], span[self.SPAN_X0])
+                    acc[5] = max(acc[5], span[self.SPAN_X1])
+                    acc[6] |= span[self.SPAN_FLAGS]
+                acc[3].append(text)
+            if acc is not None:
+                lines.append((acc[0], acc[1], acc[2], ''.join(acc[3]).strip(), acc[4], acc[5], acc[6]))
+            self._lines[index] = lines
+        return self._lines[index]
+
+    def text(self, max_pages: int = 2, max_chars: int = 4000) -> str:
+        """先頭 max_pages ページのテキスト（max_chars に達したら打ち切り）"""
+        parts = []
+        for i in range(min(self.page_count, max_pages)):
+            parts.append(self.page_text(i))
+            if sum(len(t) for t in parts) >= max_chars:
+                break
+        return "\n".join(parts).strip()[:max_chars]
+
+    def page_size(self, index: int) -> tuple[float, float]:
+        """回転を反映したページサイズ（ポイント）"""
+        rect = self._doc[index].rect
+        return rect.width, rect.height
+
+    def render(self, index: int, scale: float = 1.0, colorspace: str = 'rgb', clip=None):
+        """指定倍率のピクスマップ（同じページ・倍率・色空間・切り出し範囲は再レンダリングしない）
+        colorspace: 'rgb' / 'gray' / 'bilevel'（2値はグレーでレンダリングし、画像化時に2値化する）
+        clip: (x0, y0, x1, y1) ページ座標の切り出し範囲（None ならページ全体）
+        """
+        key = self._render_key(index, scale, colorspace, clip)
+        gray, clip = key[2], key[3]
+        pix = self._pixmaps.get(key)
+        if pix is None:
+            self._reserve(key, self._estimate_render_bytes(index, scale, gray, clip))
+            matrix = fitz.Matrix(scale, scale) if scale != 1.0 else fitz.Identity
+            kwargs = {'matrix': matrix}
+            if gray:
+                kwargs['colorspace'] = fitz.csGRAY
+            if clip:
+                kwargs['clip'] = fitz.Rect(*clip)
+            try:
+                pix = self._doc[index].get_pixmap(**kwargs)
+            except Exception:
+                self._release(key)
+                raise
+            self._pixmaps[key] = pix
+        return pix
+
+    @staticmethod
+    def _render_key(index, scale, colorspace, clip):
+        clip = tuple(round(v, 1) for v in clip) if clip else None
+        return (index, round(scale, 4), colorspace in ('gray', 'bilevel'), clip)
+
+    def discard_render(self, index: int, scale: float, colorspace: str = 'rgb', clip=None):
+        """エンコード済みなどで不要になったピクスマップを手放す（メモリ予算も返却）"""
+        key = self._render_key(index, scale, colorspace, clip)
+        self._pixmaps.pop(key, None)
+        self._release(key)
+
+    def _estimate_render_bytes(self, index, scale, gray, clip) -> int:
+        """ピクスマップと、そこから作る画像・エンコード結果を合わせた概算バイト数"""
+        if clip:
+            width, height = clip[2] - clip[0], clip[3] - clip[1]
+        else:
+            width, height = self.page_size(index)
+        channels = 1 if gray else 3
+        return int(width * scale * height * scale * channels * 2)
+
+    def _reserve(self, key, nbytes: int):
+        if self.governor is None:
+            return
+        # 最初の1枚だけ空きを待つ（確保済みのジョブを待たせると互いに待ち合って止まるため）
+        self.governor.acquire(nbytes, wait=(self.reserved_bytes == 0))
+        self._pix_bytes[key] = nbytes
+        self.reserved_bytes += nbytes
+        self.peak_reserved_bytes = max(self.peak_reserved_bytes, self.reserved_bytes)
+
+    def _release(self, key):
+        nbytes = self._pix_bytes.pop(key, 0)
+        if nbytes and self.governor is not None:
+            self.governor.release(nbytes)
+            self.reserved_bytes -= nbytes
+
+    # 切り出し範囲の余白（pt）
+    REGION_MARGIN = 18.0
+    ADDRESSEE_RE = re.compile(r'(様|御中|殿)\s*$|(様|御中|殿)[\s　]')
+
+    def region_rect(self, index: int, region: str, fallback_fraction: float):
+        """ページ内の注目領域 (x0, y0, x1, y1) を返す（全体を使うべき場合は None）。
+        region='header': タイトルと宛名（様/御中/殿）を含む上部の帯
+        region='registry': 登記事項の「表題部」（次の「権利部」の手前まで）
+        テキスト層の行位置から決め、無ければページ上部 fallback_fraction の範囲を使う。
+        """
+        page = self._doc[index]
+        if page.rotation:
+            # 回転ページは切り出し座標の扱いが変わるため全体を使う
+            return None
+        width, height = self.page_size(index)
+        fraction = min(1.0, max(0.1, float(fallback_fraction)))
+        fallback = (0.0, 0.0, width, height * fraction)
+        try:
+            lines = self.page_lines(index)
+        except Exception:
+            lines = []
+        if not lines:
+            return fallback
+        margin = self.REGION_MARGIN
+        if region == 'registry':
+            # 見出しは「表　題　部」のように字間に空白（全角含む）が入ることが多い
+            compact = [''.join(ln[3].split()) for ln in lines]
+            start = next((ln for ln, t in zip(lines, compact) if '表題部' in t), None)
+            if start is None:
+                return fallback
+            top = max(0.0, start[0] - margin)
+            end = min((ln[0] for ln, t in zip(lines, compact) if '権利部' in t and ln[0] > start[1]), default=None)
+            bottom = end if end is not None else top + height * fraction
+            return (0.0, top, width, min(height, bottom + margin))
+        # header: 上部6割にあるタイトル（最大フォント）と宛名行まで
+        upper = [ln for ln in lines if ln[0] < height * 0.6]
+        if not upper:
+            return fallback
+        anchors = [max(upper, key=lambda ln: ln[2])]
+        anchors += [ln for ln in upper if self.ADDRESSEE_RE.search(ln[3])]
+        bottom = max(ln[1] for ln in anchors) + margin * 2
+        bottom = max(bottom, height * 0.15)
+        if bottom >= height * 0.9:
+            return None
+        return (0.0, 0.0, width, bottom)
+
+    # 自動判定のしきい値（彩度がこれを超える画素が COLOR_RATIO 以上ならカラー扱い）
+    THUMB_EDGE = 96
+    COLOR_CHROMA = 40
+    COLOR_RATIO = 0.01
+    BILEVEL_THRESHOLD = 176
+
+    def is_monochrome(self, index: int) -> bool:
+        """低解像度サムネイルの彩度分布から白黒ページかを判定する（結果はキャッシュ）"""
+        if index not in self._mono:
+            width, height = self.page_size(index)
+            scale = min(1.0, self.THUMB_EDGE / max(width, height, 1.0))
+            pix = self._doc[index].get_pixmap(matrix=fitz.Matrix(scale, scale))
+            samples = pix.samples
+            if pix.n < 3:
+                self._mono[index] = True
+            else:
+                n = pix.n
+                r, g, b = samples[0::n], samples[1::n], samples[2::n]
+                colored = sum(1 for x, y, z in zip(r, g, b) if max(x, y, z) - min(x, y, z) > self.COLOR_CHROMA)
+                self._mono[index] = colored < max(1, len(r) * self.COLOR_RATIO)
+        return self._mono[index]
+
+    def resolve_colorspace(self, index: int, requested: str) -> str:
+        """フォルダ設定の色空間（auto/rgb/gray/bilevel）をページごとの実際の指定に解決する"""
+        requested = (requested or 'auto').lower()
+        if requested in ('rgb', 'gray', 'bilevel'):
+            return requested
+        try:
+            return 'gray' if self.is_monochrome(index) else 'rgb'
+        except Exception:
+            return 'rgb'
+
+    @classmethod
+    def to_bilevel(cls, image):
+        """PIL画像を2値（白黒）にする"""
+        threshold = cls.BILEVEL_THRESHOLD
+        return image.convert('L').point(lambda v: 255 if v >= threshold else 0, mode='1')
+
+    # API送信画像の上限（5MB制限に対する安全マージン）
+    MAX_PAYLOAD_BYTES = 4_900_000
+
+    def image_block(self, index: int, scale: float, fmt: str = 'jpeg', quality: int = 85,
+                    colorspace: str = 'rgb', clip=None) -> dict:
+        """(ページ, 倍率, 形式, 品質, 色空間) ごとに1回だけエンコードした base64 画像ブロック。
+        JPEG/PNG はピクスマップから直接、WebP はピクセル列から PIL で直接エンコードする（PNG経由なし）。
+        2値は形式によらず1bit PNG（JPEGでは文字がにじむため）。
+        上限を超える場合は ValueError を送出する。
+        """
+        fmt = (fmt or 'jpeg').lower()
+        key = (index, round(scale, 4), fmt, int(quality), colorspace, tuple(round(v, 1) for v in clip) if clip else None)
+        block = self._payloads.get(key)
+        if block is not None:
+            return block
+        if self.farm is not None:
+            # ワーカー側のピクスマップもこのジョブのメモリ予算に計上する
+            farm_key = ('farm',) + key
+            data_key = ('farm-data',) + key
+            gray = colorspace in ('gray', 'bilevel')
+            pages = [(index, scale, fmt, quality, colorspace, clip)]
+            self._reserve(farm_key, self._estimate_render_bytes(index, scale, gray, clip))
+            try:
+                # まずファイル内容なしで依頼し、ワーカーがこの文書を開いていなかった時だけ内容を送る
+                blocks = self.farm.encode(self.path, self.token, None, pages)
+                if blocks is None:
+                    self._reserve(data_key, len(self._data))
+                    blocks = self.farm.encode(self.path, self.token, self._data, pages)
+                block = blocks[0]
+                self._payloads[key] = block
+                return block
+            except Exception as e:
+                print(f"レンダリングプロセスエラー（このプロセスで続行）: {e}")
+            finally:
+                self._release(data_key)
+                self._release(farm_key)
+        pix = self.render(index, scale, colorspace, clip)
+        if colorspace == 'bilevel':
+            img = self.to_bilevel(Image.frombytes('L', (pix.width, pix.height), pix.samples))
+            buf = io.BytesIO()
+            img.save(buf, format='PNG', optimize=True)
+            data, media_type = buf.getvalue(), 'image/png'
+        elif fmt == 'png':
+            data, media_type = pix.tobytes('png'), 'image/png'
+        elif fmt == 'webp':
+            mode = 'L' if pix.n == 1 else 'RGB'
+            img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+            buf = io.BytesIO()
+            img.save(buf, format='WEBP', quality=int(quality), method=4)
+            data, media_type = buf.getvalue(), 'image/webp'
+        else:
+            try:
+                data = pix.tobytes('jpg', jpg_quality=int(quality))
+            except TypeError:
+                # 古い PyMuPDF は品質指定なしの JPEG 出力のみ
+                mode = 'L' if pix.n == 1 else 'RGB'
+                buf = io.BytesIO()
+                Image.frombytes(mode, (pix.width, pix.height), pix.samples).save(buf, format='JPEG', quality=int(quality))
+                data = buf.getvalue()
+            media_type = 'image/jpeg'
+        if len(data) > self.MAX_PAYLOAD_BYTES:
+            raise ValueError(f"画像が大きすぎます: {len(data)} bytes")
+        block = {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": base64.b64encode(data).decode('ascii')
+            }
+        }
+        self._payloads[key] = block
+        # エンコード後はピクスマップを保持しない
+        self.discard_render(index, scale, colorspace, clip)
+        return block
+
+    def close(self):
+        self._mono.clear()
+        self._payloads.clear()
+        self._pixmaps.clear()
+        for key in list(self._pix_bytes):
+            self._release(key)
+        self._spans.clear()
+        self._texts.clear()
+        self._lines.clear()
+        try:
+            if self._doc is not None:
+                self._doc.close()
+        except Exception:
+            pass
+        self._doc = None
+        self._data = None
+
+class MemoryGovernor:
+    """レンダリング画像バッファ全体のメモリ予算。
+    予算に空きができるまで新しいジョブのレンダリングを待たせ、同時に抱える画像の総量を抑える。
+    1件目は予算を超えていても通す（巨大ページで永久に止まらないように）。
+    """
+
+    def __init__(self, budget_bytes: int, max_wait: float = 300.0):
+        self.budget_bytes = max(1, int(budget_bytes))
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._used = 0
+        self.peak_bytes = 0
+        self.waits = 0
+
+    def acquire(self, nbytes: int, wait: bool = True) -> float:
+        """nbytes を確保する（wait=True なら空きを待つ）。待った秒数を返す"""
+        start = time.monotonic()
+        with self._cond:
+            if wait and self._used > 0 and self._used + nbytes > self.budget_bytes:
+                self.waits += 1
+                deadline = start + self.max_wait
+                while self._used > 0 and self._used + nbytes > self.budget_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self._used += nbytes
+            self.peak_bytes = max(self.peak_bytes, self._used)
+        return time.monotonic() - start
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self._used = max(0, self._used - nbytes)
+            self._cond.notify_all()
+
+    def usage(self) -> tuple[int, int]:
+        with self._cond:
+            return self._used, self.budget_bytes
+
+class LayoutTitleEngine:
+    """1ページ目の行からタイトル行を選ぶ。
+    大きめの文字で最上部の行を候補とし、同じ高さに並ぶ見出し断片（段組みで分かれた見出し）を左から結合、
+    直下に続く同等サイズの行を探す。y0 で1回だけ並べ替えて二分探索する。
+    lines: [(y0, x0, x1, size, flags, text)]（ノイズ行は除去済みであること）
+    """
+
+    MIN_TITLE_SIZE = 12.0
+    LARGE_RATIO = 1.25
+    FALLBACK_TOP = 10
+    BOLD_FLAG = 16
+
+    def __init__(self, lines: list[tuple]):
+        self.lines = lines
+
+    def select(self):
+        """(タイトル行テキスト, 直下の続き行テキスト or None)。行が無ければ None"""
+        if not self.lines:
+            return None
+        return self._select()
+
+    @staticmethod
+    def _tolerance(size: float) -> float:
+        return max(1.0, size * 0.1)
+
+    def _row_peers(self, cand: int, peers) -> list[int]:
+        """候補と同じ高さ・同等サイズの行のうち、左右に隣接して続く断片（左から順）。
+        重なっている行（重ね書きの太字など）は同じ文字列の重複として除く。
+        """
+        lines = self.lines
+        size = lines[cand][3]
+        peers = sorted(peers, key=lambda i: (lines[i][1], i))
+
+        def chain(candidates, forward):
+            picked, edge = [], (lines[cand][2] if forward else lines[cand][1])
+            for i in candidates:
+                x0, x1 = lines[i][1], lines[i][2]
+                gap = (x0 - edge) if forward else (edge - x1)
+                if gap < -size * 0.5:
+                    continue
+                if gap > size * 2:
+                    break
+                picked.append(i)
+                edge = x1 if forward else x0
+            return picked
+
+        k = peers.index(cand) if cand in peers else None
+        if k is None:
+            return [cand]
+        left = chain(reversed(peers[:k]), forward=False)
+        right = chain(peers[k + 1:], forward=True)
+        return list(reversed(left)) + [cand] + right
+
+    def _finish(self, row: list[int], next_idx):
+        """見出し断片（左から順）と続き行からテキストを組み立てる"""
+        title = ''
+        for i in row:
+            text = self.lines[i][5]
+            # 日本語どうしは詰めてつなぎ、英数字が接する場合だけ空白を入れる
+            if title and (title[-1].isascii() or text[:1].isascii()):
+                title += ' '
+            title += text
+        next_text = self.lines[next_idx][5].strip() if next_idx is not None else None
+        return title, next_text
+
+    def _select(self):
+        lines = self.lines
+        order = sorted(range(len(lines)), key=lambda i: lines[i][0])
+        ys = [lines[i][0] for i in order]
+        sizes = [t[3] for t in lines]
+        thr = max(self.MIN_TITLE_SIZE, stats.median(sizes) * self.LARGE_RATIO)
+        candidates = [i for i, sz in enumerate(sizes) if sz >= thr]
+        if not candidates:
+            # 代替: 上位サイズ10件から最上部を優先
+            candidates = sorted(range(len(lines)), key=lambda i: -sizes[i])[:self.FALLBACK_TOP]
+        cand = min(candidates, key=lambda i: (lines[i][0], -sizes[i], -(lines[i][4] & self.BOLD_FLAG)))
+        y, size = lines[cand][0], sizes[cand]
+        tol = self._tolerance(size)
+        lo = bisect.bisect_left(ys, y - size * 0.5)
+        hi = bisect.bisect_right(ys, y + size * 0.5)
+        row = self._row_peers(cand, [order[k] for k in range(lo, hi) if abs(sizes[order[k]] - size) <= tol])
+        # 直下行: 見出しより下で最初に現れる同等サイズの行
+        start = bisect.bisect_right(ys, max(lines[i][0] for i in row))
+        next_idx = next((order[k] for k in range(start, len(order)) if abs(sizes[order[k]] - size) <= tol), None)
+        return self._finish(row, next_idx)
+
+class TextQualityScorer:
+    """PDFのテキスト層が読めるテキストかを API を使わずに採点する（0〜1）。
+    文字化け・CIDの残骸・同じ字形の繰り返しなど、壊れたOCR層を画像判定へ回すために使う。
+    指標: 日本語/英数字として妥当な文字の割合、かな率、置換文字・私用領域・制御文字の率、
+    辞書語の出現率、トークンの平均長、同一文字の連続。
+    """
+
+    # 事務書類によく出る語（辞書語の出現率に使う）
+    DICTIONARY = frozenset("""
+        株式会社 有限会社 合同会社 御中 様 殿 年 月 日 令和 平成 昭和 住所 所在 氏名 名称 代表 電話 番号
+        請求 見積 納品 領収 契約 申込 申請 通知 案内 証明 登記 事項 全部 現在 建物 土地 地番 家屋 表題 権利
+        金額 合計 小計 税込 税抜 消費税 支払 期限 振込 口座 銀行 支店 普通 当座 内容 数量 単価 備考 以上
+        確認 お願い 下記 上記 について ください ます です した する こと ため もの および または 及び 又は
+        計算 資料 報告 決算 申告 所得 法人 住民 固定 資産 評価 課税 納税 保険 年金 給与 源泉 徴収 控除
+        会社 事務所 担当 部署 受付 発行 提出 送付 返信 期日 本日 以下 当社 弊社 貴社 お客様
+        invoice total date amount tax payment account bank name address company office number page
+        the and of to for in on with from by this that is are be
+    """.split())
+
+    TOKEN_RE = re.compile(r'[\u4e00-\u9fff\u3005]+|[\u3041-\u309f]+|[\u30a0-\u30ff]+|[A-Za-z]+|[0-9]+')
+    REPEAT_RE = re.compile(r'(.)\1{5,}')
+    CID_RE = re.compile(r'\(cid:\d+\)')
+
+    @staticmethod
+    def _char_class(ch: str) -> str:
+        o = ord(ch)
+        if 0x3041 <= o <= 0x309F or 0x30A0 <= o <= 0x30FF:
+            return 'kana'
+        if 0x4E00 <= o <= 0x9FFF or o == 0x3005:
+            return 'kanji'
+        if ch.isascii() and ch.isalnum():
+            return 'ascii'
+        if o == 0xFFFD or 0xE000 <= o <= 0xF8FF or (o < 32 and ch not in '\t\r\n'):
+            return 'bad'
+        if 0xFF10 <= o <= 0xFF5A or 0x3000 <= o <= 0x303F or 0xFF01 <= o <= 0xFF0F or ch in '.,:;-/()[]%&@#*+=¥$\'"!?~_|<>':
+            return 'punct'
+        return 'other'
+
+    @classmethod
+    def _has_word(cls, token: str) -> bool:
+        """トークン自身、または長さ2〜4の部分文字列が辞書語か"""
+        if token.lower() in cls.DICTIONARY:
+            return True
+        token = token[:40]
+        for n in (2, 3, 4):
+            for i in range(len(token) - n + 1):
+                if token[i:i + n] in cls.DICTIONARY:
+                    return True
+        return False
+
+    # これ未満の文字数は判定しない（表紙の「見積書」だけ等は壊れたOCRと区別できない）
+    MIN_CHARS = 20
+
+    @classmethod
+    def score(cls, text: str) -> tuple[float | None, dict]:
+        """(スコア, 指標) を返す。本文が少なすぎて判定できない場合のスコアは None"""
+        compact = ''.join((text or '').split())
+        detail = {'chars': len(compact)}
+        if len(compact) < cls.MIN_CHARS:
+            return None, detail
+        counts = {'kana': 0, 'kanji': 0, 'ascii': 0, 'bad': 0, 'punct': 0, 'other': 0}
+        for ch in compact:
+            counts[cls._char_class(ch)] += 1
+        n = len(compact)
+        cid = len(cls.CID_RE.findall(text))
+        bad_rate = (counts['bad'] + cid * 6) / n
+        valid_rate = (counts['kana'] + counts['kanji'] + counts['ascii'] + counts['punct']) / n
+        cjk = counts['kana'] + counts['kanji']
+        kana_ratio = counts['kana'] / cjk if cjk else None
+        tokens = cls.TOKEN_RE.findall(text)
+        words = [t for t in tokens if not t.isdigit()]
+        avg_len = sum(len(t) for t in words) / len(words) if words else 0.0
+        hits = sum(1 for t in words if cls._has_word(t))
+        hit_rate = hits / len(words) if words else 0.0
+        repeated = sum(len(m.group(0)) for m in cls.REPEAT_RE.finditer(compact)) / n
+
+        score = valid_rate * (1.0 - min(1.0, bad_rate * 5))
+        if kana_ratio is not None and cjk >= n * 0.3 and kana_ratio < 0.05:
+            # 漢字ばかりでかなが殆ど無いのは化けたOCR層に多い（表中心の帳票もあるので軽めに）
+            score *= 0.7
+        if avg_len < 1.3 or avg_len > 12:
+            score *= 0.6
+        score *= 0.6 + 0.4 * min(1.0, hit_rate * 4)
+        score *= 1.0 - min(0.8, repeated * 2)
+        detail.update({
+            'valid': round(valid_rate, 3), 'bad': round(bad_rate, 3),
+            'kana': round(kana_ratio, 3) if kana_ratio is not None else None,
+            'dict': round(hit_rate, 3), 'avg_len': round(avg_len, 2), 'repeat': round(repeated, 3),
+        })
+        return round(max(0.0, min(1.0, score)), 3), detail
+
+class AddresseeExtractor:
+    """1ページ目のテキスト層（位置つきの行）から宛名を推定し、確信度（0〜1）を付ける。
+    敬称（様/御中/殿）の直前を宛名とみなし、法人格（株式会社など）で法人名を切り出す。
+    宛名は通常ページ上部の左側にあるため、位置も確信度に反映する（右側は差出人が多い）。
+    """
+
+    # 敬称は行末か空白の直前にあるものだけ（「山田様には…」のような本文中の言及は除く）
+    HONORIFIC_RE = re.compile(r'(御中|様|殿)(?=[\s　]|$)')
+    CORP_WORDS = ('株式会社', '有限会社', '合同会社', '合資会社', '合名会社',
+                  '一般社団法人', '一般財団法人', '公益社団法人', '公益財団法人',
+                  '医療法人社団', '医療法人財団', '医療法人', '社会福祉法人', '学校法人', '宗教法人',
+                  '特定非営利活動法人', 'NPO法人', '税理士法人', '司法書士法人', '弁護士法人',
+                  '行政書士法人', '社会保険労務士法人', '監査法人',
+                  '(株)', '（株）', '㈱', '(有)', '（有）', '㈲', '(同)', '（同）')
+    _corp = '|'.join(re.escape(w) for w in sorted(CORP_WORDS, key=len, reverse=True))
+    CORP_RE = re.compile(rf'(?:{_corp})[ 　]*[^\s　、，,。:：]+|[^\s　、，,。:：]+?(?:{_corp})')
+    CORP_TAIL_RE = re.compile(rf'(?:{_corp})$')
+    # 敬称の直前がこれらで終わるなら宛名ではない（皆様・お客様・同様・仕様など）
+    NOT_NAME_ENDINGS = ('皆', '客', '同', '模', '仕', '多', '貴', '神', '王', '仏', '各')
+    GENERIC_WORDS = ('ご担当者', '御担当者', '担当者', 'ご担当', '御担当', '関係者', '各位')
+    ROLE_RE = re.compile(r'^(?:代表取締役.*|取締役.*|.*社長|.*会長|.*部長|.*課長|.*係長|.*主任|.*所長|.*店長|'
+                         r'.*院長|.*理事長|.*代表者?|.*担当|.*部|.*課|.*室|.*係|.*支店|.*営業所|.*事務所|.*センター)$')
+    ADDRESS_RE = re.compile(r'(?:都|道|府|県|市|区|郡|町|村|丁目|番地|番|号)$|[0-9０-９〒]')
+    # 名前の1語は漢字だけ・ひらがなだけ・カタカナだけ・英字だけのいずれか（「いつも山田」のような混在は本文）
+    NAME_TOKEN_RE = re.compile(r'^(?:[々一-鿿]{1,6}|[ぁ-ゖー]{1,6}|[ァ-ヺー・]{1,12}|[A-Za-z][A-Za-z.\-]{0,19})$')
+    HIRAGANA_RE = re.compile(r'[ぁ-ゖ]')
+    # ひらがなの後に別の字種が続く（「いつもABC株式会社」など、文の途中から切り出した形）
+    PROSE_RE = re.compile(r'[ぁ-ゖ][^ぁ-ゖ\s　]')
+    LABEL_RE = re.compile(r'^.*?[:：]')
+    # 形がはっきりしない（1語だけの姓名・法人格の無い御中）宛名の確信度の上限。
+    # 既定のしきい値（0.75）未満に抑え、画像での確認に回す
+    UNCLEAN_CAP = 0.7
+
+    @classmethod
+    def extract(cls, lines, width: float, height: float) -> tuple[dict | None, float, str]:
+        """lines: [(y0, y1, size, text, x0, x1, flags)]。(宛名 or None, 確信度, 根拠の行)"""
+        empty = (None, 0.0, '')
+        if not lines or width <= 0 or height <= 0:
+            return empty
+        sizes = sorted(ln[2] for ln in lines)
+        median_size = sizes[len(sizes) // 2]
+        candidates = []
+        for i, ln in enumerate(lines):
+            for m in cls.HONORIFIC_RE.finditer(ln[3]):
+                segment = ln[3][:m.start()].strip()
+                x0, evidence = ln[4], ln[3].strip()
+                if not segment:
+                    # 敬称だけの行は、同じ高さで左隣にある行と合わせる
+                    peer = cls._left_peer(lines, i)
+                    if peer is None:
+                        continue
+                    segment, x0 = peer[3].strip(), peer[4]
+                    evidence = f"{segment} {ln[3].strip()}"
+                info, clean = cls._parse(segment, m.group(1))
+                if not info:
+                    continue
+                conf = 0.45
+                if ln[0] < height * 0.45:
+                    conf += 0.2
+                if (x0 + ln[5]) / 2 < width * 0.6:
+                    conf += 0.1
+                conf += 0.2 if clean else 0.05
+                if ln[2] >= median_size:
+                    conf += 0.05
+                conf = min(conf, 1.0 if clean else cls.UNCLEAN_CAP)
+                candidates.append((conf, ln[0], info, evidence))
+        if not candidates:
+            return empty
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+        best_conf, _, info, evidence = candidates[0]
+        # 別の宛名が同程度の確信度で並ぶなら、どちらか決めきれない
+        rival = next((c for c in candidates[1:] if c[2] != info), None)
+        if rival is not None and rival[0] >= best_conf - 0.1:
+            best_conf -= 0.3
+        return info, round(max(best_conf, 0.0), 3), evidence
+
+    @staticmethod
+    def _left_peer(lines, index):
+        """lines[index] と同じ高さで左側にある最も近い行"""
+        y0, y1, size, _, x0 = lines[index][:5]
+        mid = (y0 + y1) / 2
+        best, best_gap = None, size * 8
+        for j, ln in enumerate(lines):
+            if j == index or not (ln[0] <= mid <= ln[1]) or ln[5] > x0 + 1:
+                continue
+            gap = x0 - ln[5]
+            if gap < best_gap:
+                best, best_gap = ln, gap
+        return best
+
+    @classmethod
+    def _parse(cls, segment: str, honorific: str) -> tuple[dict | None, bool]:
+        """敬称の直前の文字列を法人名・姓・名に分ける。(結果 or None, 形がはっきりしているか)"""
+        segment = cls.LABEL_RE.sub('', segment).strip()
+        segment = re.sub(r'[ 　]+', ' ', segment)
+        if not segment or segment.endswith(cls.NOT_NAME_ENDINGS):
+            return None, False
+        info = {'surname': None, 'given_name': None, 'company_name': None}
+        corp = cls.CORP_RE.search(segment)
+        if corp and (cls.HIRAGANA_RE.search(segment[:corp.start()])
+                     or (not corp.group(0).startswith(cls.CORP_WORDS)
+                         and cls.PROSE_RE.search(cls.CORP_TAIL_RE.sub('', corp.group(0))))):
+            # 法人名の前が文になっている（本文中の言及。「株式会社あおぞら…」のような前株は対象外）
+            return None, False
+        if honorific == '御中':
+            # 御中は組織宛て（部署名まで含めて法人名とする）
+            start = corp.start() if corp else 0
+            if not corp and cls.HIRAGANA_RE.search(segment):
+                return None, False
+            info['company_name'] = segment[start:].strip()
+            return info, corp is not None
+        rest = segment
+        if corp:
+            info['company_name'] = corp.group(0).strip()
+            rest = segment[corp.end():]
+        tokens = [t for t in rest.split(' ') if t]
+        if tokens and tokens[-1].endswith(cls.GENERIC_WORDS):
+            # 「ご担当者様」などは個人名なし
+            return (info, True) if info['company_name'] else (None, False)
+        names = []
+        for t in reversed(tokens):
+            if cls.ROLE_RE.match(t) or cls.ADDRESS_RE.search(t) or not cls.NAME_TOKEN_RE.match(t):
+                break
+            names.insert(0, t)
+            if len(names) == 2:
+                break
+        if any(cls.HIRAGANA_RE.search(t) for t in tokens[:len(tokens) - len(names)]):
+            # 名前の前にかなを含む語がある → 本文の一部
+            return None, False
+        if names:
+            info['surname'] = names[0]
+            if len(names) == 2:
+                info['given_name'] = names[1]
+        if not (info['company_name'] or info['surname']):
+            return None, False
+        # 姓名が空白で分かれている / 法人名がある → はっきりしている
+        return info, bool(info['company_name']) or len(names) == 2
+
+
+class KeywordMatcher:
+    """複数カテゴリのキーワードを1本の正規表現にまとめ、テキストを1回走査して全カテゴリの出現数を数える。
+    各位置で最長一致のキーワードを先読みで拾い、その接頭辞になっているキーワードも同位置の一致として
+    数えるため、重なり合う語（例: 計算書 / 損益計算書）もキーワードごとの str.count と同じ数になる。
+    """
+
+    def __init__(self, categories: dict):
+        self.categories = {}
+        keywords = []
+        for name, words in categories.items():
+            lowered = []
+            for w in words:
+                w = (w or '').lower()
+                if w and w not in lowered:
+                    lowered.append(w)
+                if w and w not in keywords:
+                    keywords.append(w)
+            self.categories[name] = tuple(lowered)
+        keywords.sort(key=len, reverse=True)
+        self.keywords = tuple(keywords)
+        # 最長一致キーワード → 同じ位置で一致しているキーワード（自身と接頭辞）
+        self._prefixes = {k: tuple(o for o in keywords if k.startswith(o)) for k in keywords}
+        if keywords:
+            # 先頭文字の文字クラスで候補位置を先に絞る（無いと全位置で全候補を試して遅い）
+            first = ''.join(sorted({re.escape(k[0]) for k in keywords}))
+            pattern = '|'.join(re.escape(k) for k in keywords)
+            self._regex = re.compile(f'(?=[{first}])(?=({pattern}))', re.IGNORECASE)
+        else:
+            self._regex = re.compile('(?!)')
+
+    def scan(self, text: str) -> dict:
+        """キーワード → (出現数, 最初の出現位置)"""
+        hits = {}
+        if not text:
+            return hits
+        prefixes = self._prefixes
+        for m in self._regex.finditer(text):
+            pos = m.start()
+            for k in prefixes[m.group(1).lower()]:
+                h = hits.get(k)
+                hits[k] = (h[0] + 1, h[1]) if h else (1, pos)
+        return hits
+
+    def count(self, hits: dict, category: str) -> int:
+        """scan() の結果からカテゴリの合計出現数"""
+        return sum(hits[k][0] for k in self.categories.get(category, ()) if k in hits)
+
+    def counts(self, text: str) -> dict:
+        """カテゴリ → 合計出現数（1回の走査）"""
+        hits = self.scan(text)
+        return {name: self.count(hits, name) for name in self.categories}
+
+    def has(self, text: str, category: str) -> bool:
+        hits = self.scan(text)
+        return any(k in hits for k in self.categories.get(category, ()))
+
+    def first_category(self, text: str, names) -> str | None:
+        """names の順で最初に一致したカテゴリ"""
+        hits = self.scan(text)
+        for name in names:
+            if any(k in hits for k in self.categories.get(name, ())):
+                return name
+        return None
+
+
+class DocumentKeywords:
+    """文書種別ヒューリスティックが使うキーワード表と、起動時に1度だけ組み立てる共有マッチャ"""
+
+    # 主たる書類候補（並び順が優先順）
+    PRIMARY = [
+        ('計算書', ['計算書', '損益計算書', '貸借対照表', '決算書', '財務諸表']),
+        ('契約書', ['契約書', '覚書', '合意書']),
+        ('見積書', ['見積書']),
+        ('請求書', ['請求書', '請求金額']),
+        ('領収書', ['領収書', '受領']),
+        ('納品書', ['納品書']),
+    ]
+    # 従たる/汎用キーワード
+    SECONDARY = ['資料', '添付資料', '参考資料', '別紙', '付録', '別添']
+    FINANCIAL = ['計算書', '損益計算書', '貸借対照表', '決算書']
+    REGISTRY = ['登記事項証明書', '登記情報', '登記簿', '全部事項証明書', '現在事項証明書',
+                '建物事項証明書', '土地登記', '建物登記', '不動産登記']
+    # 分類名の標準化（並び順が優先順）
+    NORMALIZE = [
+        # 司法書士系の正規化
+        ('印鑑証明書', ['印鑑証明']),
+        ('登記事項証明書', ['登記事項証明', '全部事項証明', '現在事項証明']),
+        # 一般書類
+        ('請求書', ['請求']),
+        ('見積書', ['見積']),
+        ('領収書', ['領収']),
+        ('納品書', ['納品']),
+        ('注文書', ['注文']),
+        ('契約書', ['契約']),
+    ]
+
+    _matcher = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def matcher(cls) -> KeywordMatcher:
+        with cls._lock:
+            if cls._matcher is None:
+                categories = {f'primary:{n}': kws for n, kws in cls.PRIMARY}
+                categories['secondary'] = cls.SECONDARY
+                categories['financial'] = cls.FINANCIAL
+                categories['registry'] = cls.REGISTRY
+                categories.update({f'normalize:{n}': kws for n, kws in cls.NORMALIZE})
+                categories.update({f'rule:{label}': [w for w, _ in kws]
+                                   for label, kws in LocalDocumentClassifier.RULES.items()})
+                cls._matcher = KeywordMatcher(categories)
+            return cls._matcher
+
+
+class LocalDocumentClassifier:
+    """テキスト層のキーワードから文書種別を推定し、確信度（0〜1）を付ける。
+    確信度が十分なら分類APIを呼ばずにその種別を使う。
+    見出し（本文先頭付近）に現れる語は重く、本文中の出現は回数を抑えて数える。
+    """
+
+    # 種別 → [(キーワード, 重み)]
+    RULES = {
+        '登記事項証明書': [('登記事項証明書', 3), ('全部事項証明書', 3), ('現在事項証明書', 3), ('表題部', 2),
+                        ('権利部', 2), ('甲区', 1), ('乙区', 1), ('地番', 1), ('家屋番号', 1)],
+        '印鑑証明書': [('印鑑証明書', 3), ('印鑑登録証明書', 3), ('印鑑登録', 1)],
+        '契約書': [('契約書', 3), ('甲と乙', 1), ('第1条', 1), ('契約期間', 1), ('合意書', 2)],
+        '覚書': [('覚書', 3)],
+        '議事録': [('議事録', 3), ('議長', 1), ('決議', 1), ('出席', 1)],
+        '定款': [('定款', 3), ('商号', 1), ('発起人', 1)],
+        '委任状': [('委任状', 3), ('委任します', 2), ('代理人', 1)],
+        '就任承諾書': [('就任承諾書', 3), ('就任を承諾', 2)],
+        '見積書': [('見積書', 3), ('御見積', 2), ('お見積', 2), ('見積金額', 2), ('有効期限', 1)],
+        '請求書': [('請求書', 3), ('御請求', 2), ('ご請求', 2), ('請求金額', 2), ('お支払期限', 1), ('振込先', 1)],
+        '領収書': [('領収書', 3), ('領収いたしました', 2), ('上記正に', 2), ('但し', 1)],
+        '注文書': [('注文書', 3), ('発注書', 3), ('ご注文', 1), ('発注', 1)],
+        '納品書': [('納品書', 3), ('納品いたします', 2), ('納品日', 1)],
+        '仕様書': [('仕様書', 3), ('仕様', 1)],
+        '送付状': [('送付状', 3), ('送付のご案内', 2), ('送付いたします', 1), ('ご査収', 1)],
+        '受付のお知らせ': [('受付のお知らせ', 3), ('受付番号', 1), ('受け付けました', 1)],
+        '必要書類等一覧': [('必要書類', 3), ('書類一覧', 2)],
+        '計算書': [('計算書', 3), ('損益計算書', 3), ('貸借対照表', 3), ('決算書', 3), ('財務諸表', 2)],
+    }
+    HEAD_CHARS = 200
+    HEAD_FACTOR = 3
+    BODY_CAP = 5
+    # 見出し級（書類名そのもの）のキーワードの重み。これが1つも無い種別は返さない
+    # （地番・家屋番号だけの固定資産評価証明書や名寄帳を登記事項証明書にしないため）
+    HEADING_WEIGHT = 3
+    # 「どの種別でもない」場合の基準点。1種別だけ得点したときも差の割合がこれで抑えられる
+    OTHER_BASELINE = 2.0
+
+    @classmethod
+    def classify(cls, text: str, labels) -> tuple[str | None, float, dict]:
+        """(種別 or None, 確信度, 種別ごとの得点)。labels に無い種別は候補にしない"""
+        if not text:
+            return None, 0.0, {}
+        hits = DocumentKeywords.matcher().scan(text)
+        allowed = set(labels or cls.RULES)
+        scores = {}
+        eligible = set()
+        for label, keywords in cls.RULES.items():
+            if label not in allowed:
+                continue
+            score = 0.0
+            heading = False
+            for word, weight in keywords:
+                h = hits.get(word.lower())
+                if not h:
+                    continue
+                n, first = h
+                score += weight * min(n, cls.BODY_CAP) ** 0.5
+                if first + len(word) <= cls.HEAD_CHARS:
+                    score += weight * cls.HEAD_FACTOR
+                heading = heading or weight >= cls.HEADING_WEIGHT
+            if score:
+                scores[label] = round(score, 2)
+                if heading:
+                    eligible.add(label)
+        if not scores:
+            return None, 0.0, scores
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+        best_label, best = ranked[0]
+        if best_label not in eligible:
+            return None, 0.0, scores
+        second = max(ranked[1][1] if len(ranked) > 1 else 0.0, cls.OTHER_BASELINE)
+        # 得点の大きさ（飽和）× 2位（または基準点）との差の割合
+        confidence = (1.0 - math.exp(-best / 6.0)) * max(0.0, (best - second) / best)
+        return best_label, round(confidence, 3), scores
+
+class RenderFarm:
+    """PDFのレンダリングと画像エンコードを別プロセスで行う（GILを避けて複数コアを使う）。
+    ワーカープロセスは起動時に fitz/PIL を読み込んだまま常駐し、直前のPDFを開いたまま再利用する。
+    PDFは親の ParsedDocument が読み込んだ内容を、そのワーカーがまだ開いていない時だけ渡す
+    （ワーカーはファイルを読み直さない）。
+    """
+
+    # ワーカープロセス内でのみ使う（直前に開いたPDF）
+    _worker_doc = None
+    _worker_key = None
+
+    def __init__(self, processes: int):
+        self.processes = max(1, int(processes))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, initializer=RenderFarm._warm_up)
+            return self._executor
+
+    def encode(self, path: str, token: str, data: bytes | None, pages: list, timeout: float = 120.0) -> list | None:
+        """pages: [(page, scale, fmt, quality, colorspace, clip)] → 画像ブロックのリスト
+        token: 親の ParsedDocument.token（ワーカーが同じ文書を開き直さないための識別子）
+        data: 親が読み込んだPDFの内容。None で依頼し、担当ワーカーがその文書を開いていなければ None が返る
+        """
+        future = self._get_executor().submit(RenderFarm._encode_pages, path, token, data, list(pages))
+        try:
+            return future.result(timeout=timeout)
+        except BrokenProcessPool:
+            # ワーカーが異常終了した場合は次回に作り直す
+            with self._lock:
+                self._executor = None
+            raise
+        except Exception:
+            future.cancel()
+            raise
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _warm_up():
+        # 初回ジョブで読み込み待ちが出ないよう、重いモジュールを先に初期化しておく
+        fitz.open().close()
+        Image.init()
+
+    @classmethod
+    def _encode_pages(cls, path, token, data, pages):
+        if cls._worker_key != token:
+            if data is None:
+                # この文書を開いていない: 親に内容を送ってもらう
+                return None
+            if cls._worker_doc is not None:
+                cls._worker_doc.close()
+            cls._worker_doc, cls._worker_key = None, None
+            cls._worker_doc = ParsedDocument(path, data=data)
+            cls._worker_key = token
+        doc = cls._worker_doc
+        try:
+            return [doc.image_block(index, scale, fmt, quality, colorspace, clip)
+                    for index, scale, fmt, quality, colorspace, clip in pages]
+        finally:
+            # ピクスマップは大きいので保持しない（エンコード結果のみキャッシュ）
+            doc._pixmaps.clear()
+
+class LazyPageImage:
+    """ページ画像の遅延ハンドル。Vision呼び出しが実際に画像を必要とした時に初めてレンダリングする。
+    API送信用の画像ブロックは ParsedDocument のキャッシュ経由で、ピクスマップから直接1回だけエンコードする。
+    """
+
+    def __init__(self, doc, index: int, scale: float, to_image, colorspace: str = 'auto', clip=None, parent=None):
+        self._doc = doc
+        self.index = index
+        self.scale = scale
+        self.clip = clip
+        self._to_image = to_image
+        self._requested_colorspace = colorspace
+        self._colorspace = None
+        self._parent = parent
+        self._image = None
+        self._rendered = False
+
+    @property
+    def rendered(self) -> bool:
+        return self._rendered
+
+    @rendered.setter
+    def rendered(self, value: bool):
+        self._rendered = value
+        if value and self._parent is not None:
+            # 切り出し画像のレンダリングも元ページの画像化として数える
+            self._parent.rendered = True
+
+    def region(self, name: str, fallback_fraction: float):
+        """注目領域だけを切り出したハンドル（切り出せない場合は自分自身）"""
+        clip = self._doc.region_rect(self.index, name, fallback_fraction)
+        if not clip:
+            return self
+        return LazyPageImage(self._doc, self.index, self.scale, self._to_image,
+                             self._requested_colorspace, clip=clip, parent=self)
+
+    @property
+    def colorspace(self) -> str:
+        """実際にレンダリングする色空間（auto はここで初めて判定する）"""
+        if self._colorspace is None:
+            self._colorspace = self._doc.resolve_colorspace(self.index, self._requested_colorspace)
+        return self._colorspace
+
+    def get(self):
+        """PIL画像（画像処理が必要な場合用）"""
+        if self._image is None:
+            cs = self.colorspace
+            image = self._to_image(self._doc.render(self.index, self.scale, cs, self.clip))
+            self._doc.discard_render(self.index, self.scale, cs, self.clip)
+            self._image = ParsedDocument.to_bilevel(image) if cs == 'bilevel' else image
+            self.rendered = True
+        return self._image
+
+    def content_block(self, fmt: str = 'jpeg', quality: int = 85) -> dict:
+        """APIの image コンテンツブロック（同じ形式・品質なら使い回し）"""
+        block = self._doc.image_block(self.index, self.scale, fmt, quality, self.colorspace, self.clip)
+        self.rendered = True
+        return block
 
 class FolderSettingsDialog:
     """フォルダ別設定ダイアログ"""
@@ -179,6 +2189,40 @@ class FolderSettingsDialog:
         )
         names_check.pack(anchor="w", pady=4)
 
+        # 監視方式（NAS/ネットワーク共有では変更通知が途切れることがあるためポーリングを選べる）
+        mode_frame = tk.Frame(settings_frame, bg="white")
+        mode_frame.pack(anchor="w", fill="x", pady=(10, 0))
+        tk.Label(mode_frame, text="🛰 監視方式:", bg="white", font=("Arial", 11)).pack(side="left")
+        self.watch_mode_var = tk.StringVar(value=self.folder_info.get('watch_mode', 'native'))
+        tk.Radiobutton(mode_frame, text="通常（変更通知）", value='native', variable=self.watch_mode_var,
+                       bg="white", command=self._toggle_poll_interval).pack(side="left", padx=(6, 0))
+        tk.Radiobutton(mode_frame, text="ポーリング（NAS向け）", value='polling', variable=self.watch_mode_var,
+                       bg="white", command=self._toggle_poll_interval).pack(side="left", padx=(6, 0))
+        tk.Label(mode_frame, text="間隔（秒）:", bg="white").pack(side="left", padx=(12, 0))
+        self.poll_interval_var = tk.IntVar(value=int(self.folder_info.get('poll_interval_sec', 30)))
+        self.poll_interval_spin = tk.Spinbox(mode_frame, from_=2, to=3600, width=6, textvariable=self.poll_interval_var)
+        self.poll_interval_spin.pack(side="left", padx=(4, 0))
+        self._toggle_poll_interval()
+
+        # 画像化の色（紙のスキャンはグレー/白黒にすると送信サイズと処理時間が減る）
+        color_frame = tk.Frame(settings_frame, bg="white")
+        color_frame.pack(anchor="w", fill="x", pady=(10, 0))
+        tk.Label(color_frame, text="🎨 画像化の色:", bg="white", font=("Arial", 11)).pack(side="left")
+        self.render_colorspace_var = tk.StringVar(value=self.folder_info.get('render_colorspace', 'auto'))
+        for value, label in (('auto', "自動"), ('rgb', "カラー"), ('gray', "グレー"), ('bilevel', "白黒（2値）")):
+            tk.Radiobutton(color_frame, text=label, value=value, variable=self.render_colorspace_var,
+                           bg="white").pack(side="left", padx=(6, 0))
+
+        # 処理の優先度（大量投入フォルダに他フォルダが待たされないよう配分）
+        sched_frame = tk.Frame(settings_frame, bg="white")
+        sched_frame.pack(anchor="w", fill="x", pady=(10, 0))
+        tk.Label(sched_frame, text="⚖ 処理の優先度（1〜10）:", bg="white", font=("Arial", 11)).pack(side="left")
+        self.priority_var = tk.IntVar(value=int(self.folder_info.get('priority', 5)))
+        tk.Spinbox(sched_frame, from_=1, to=10, width=4, textvariable=self.priority_var).pack(side="left", padx=(4, 0))
+        tk.Label(sched_frame, text="同時処理の上限（0=制限なし）:", bg="white").pack(side="left", padx=(12, 0))
+        self.max_concurrency_var = tk.IntVar(value=int(self.folder_info.get('max_concurrency', 0)))
+        tk.Spinbox(sched_frame, from_=0, to=32, width=4, textvariable=self.max_concurrency_var).pack(side="left", padx=(4, 0))
+
         # かんたんAI設定（プリセット + キーワード）
         easy_frame = tk.LabelFrame(
             self._content,
@@ -324,6 +2368,13 @@ class FolderSettingsDialog:
         except Exception:
             pass
 
+    def _toggle_poll_interval(self):
+        try:
+            state = 'normal' if self.watch_mode_var.get() == 'polling' else 'disabled'
+            self.poll_interval_spin.configure(state=state)
+        except Exception:
+            pass
+
     def _set_preview_text(self, text: str):
         try:
             self.prompt_preview.configure(state='normal')
@@ -340,6 +2391,18 @@ class FolderSettingsDialog:
             keywords = self.prompt_keywords_var.get()
             # ユーザーの自然文指示をそのまま使う（無効なら空）
             custom_prompt_val = (self.instruction_text.get('1.0', 'end') or '').strip() if self.use_custom_instruction.get() else ''
+            try:
+                poll_interval = max(2, int(self.poll_interval_var.get()))
+            except Exception:
+                poll_interval = 30
+            try:
+                priority = min(10, max(1, int(self.priority_var.get())))
+            except Exception:
+                priority = 5
+            try:
+                max_concurrency = max(0, int(self.max_concurrency_var.get()))
+            except Exception:
+                max_concurrency = 0
 
             self.result = {
                 'path': self.folder_info['path'],
@@ -349,6 +2412,11 @@ class FolderSettingsDialog:
                 'prompt_preset': preset_key,
                 'use_custom_instruction': self.use_custom_instruction.get(),
                 'custom_classify_prompt': custom_prompt_val if custom_prompt_val else None,
+                'watch_mode': self.watch_mode_var.get(),
+                'poll_interval_sec': poll_interval,
+                'priority': priority,
+                'max_concurrency': max_concurrency,
+                'render_colorspace': self.render_colorspace_var.get(),
             }
             print(f"設定結果: {self.result}")
             self.dialog.destroy()
@@ -392,6 +2460,8 @@ class AutoPDFWatcherAdvanced:
         except Exception:
             pass
         self.config = self.load_config()
+        # 文書種別ヒューリスティック共有のキーワードマッチャ（起動時に1度だけ構築）
+        self.keyword_matcher = DocumentKeywords.matcher()
         
         # 単一インスタンス制御は起動前に実施（main側）
         
@@ -401,12 +2471,92 @@ class AutoPDFWatcherAdvanced:
         # 使用モデル名（ユーザー設定可能）
         # 既定は Claude 4 Sonnet（API ID: claude-sonnet-4-20250514）
         self.model_name = self.config.get('model', 'claude-sonnet-4-20250514')
+        # API呼び出しの共有レート制限（全経路がここを通る）
+        limits = self.config.get('api_rate_limits', {}) or {}
+        self.rate_limiter = APIRateLimiter(
+            limits.get('requests_per_minute', 50),
+            limits.get('input_tokens_per_minute', 30000),
+            limits.get('output_tokens_per_minute', 8000),
+        )
         
-        # 監視関連（フォルダ別設定対応）
-        self.observers = []
+        # 監視関連（フォルダ別設定対応）: 共有Observer 1つ + フォルダごとのwatch
+        self.observer = None
+        # path -> {'mode': 'native'/'polling', 'watch': ObservedWatch, 'handler': PDFWatcherHandler}（ポーリング時の watch/handler は None）
+        self._watches = {}
         self.is_watching = False
         self.watch_folders = self.config.get('watch_folders', [])
-        
+        # ファイル → フォルダ設定の最長一致インデックス
+        self.folder_index = FolderSettingsIndex(self.watch_folders)
+
+        # 処理キュー（イベントごとのTimerスレッドではなく固定数ワーカーで処理）
+        default_workers = max(1, min(4, os.cpu_count() or 1))
+        try:
+            workers = int(self.config.get('worker_count', default_workers))
+        except Exception:
+            workers = default_workers
+        try:
+            capacity = int(self.config.get('queue_capacity', 200))
+        except Exception:
+            capacity = 200
+        self._queue_status_pending = False
+        self._queue_full_logged = False
+        self.job_queue = PDFJobQueue(self._run_job, workers=workers, capacity=capacity,
+                                     on_change=self._schedule_queue_status, policy=self._folder_policy)
+        self.job_queue.start()
+        # 書き込み完了検出（完成したファイルだけをキューへ渡す）
+        try:
+            stability_timeout = float(self.config.get('stability_timeout_sec', 600))
+        except Exception:
+            stability_timeout = 600.0
+        self._open_retries = {}
+        # ローカル分類の集計（試行数・命中数・API照合数・一致数）
+        self._local_classifier_stats = {'attempts': 0, 'hits': 0, 'sampled': 0, 'agreed': 0}
+        self._local_classifier_lock = threading.Lock()
+        # メモリ計測中のジョブ → 計測中に他のジョブと重なったか（tracemalloc のピークはプロセス全体の値のため）
+        self._profiling_jobs = {}
+        self._profiling_lock = threading.Lock()
+        # 遅延レンダリングの集計（対象ページ数 / 実際に画像化したページ数）
+        self._render_stats = {'pages': 0, 'rendered': 0}
+        self._render_stats_lock = threading.Lock()
+        # 自分が出力したパス（短時間だけ保持し、監視イベントを無視する）
+        self._self_produced = {}
+        self._self_produced_lock = threading.Lock()
+        self.stability_monitor = FileStabilityMonitor(
+            self._on_file_ready, on_timeout=self._on_file_not_ready, timeout=stability_timeout
+        )
+        # ポーリング監視（NAS向け。変更は完了待ちの判定に吸収）
+        self.polling_watcher = PollingFolderWatcher(self._on_polled_file,
+                                                    on_changed_file=self.stability_monitor.touch)
+        # 画像バッファのメモリ予算（同時に抱えるレンダリング画像の総量を制限）
+        try:
+            memory_budget_mb = float(self.config.get('render_memory_budget_mb', 512))
+        except Exception:
+            memory_budget_mb = 512.0
+        self.memory_governor = MemoryGovernor(memory_budget_mb * 1024 * 1024) if memory_budget_mb > 0 else None
+        # レンダリング/エンコード用のプロセスプール（0 ならこのプロセス内で処理）
+        self.render_farm = None
+        try:
+            render_processes = int(self.config.get('render_processes', 0))
+        except Exception:
+            render_processes = 0
+        if render_processes > 0:
+            self.render_farm = RenderFarm(render_processes)
+        # 処理中ジョブのジャーナル（クラッシュ/再起動後に未完了分を再開）
+        self.journal = None
+        self._journal_resumed = False
+        try:
+            db_dir = os.path.dirname(os.path.abspath(self.config_file))
+            self.journal = JobJournal(os.path.join(db_dir, 'jobs.db'))
+            self.journal.prune()
+        except Exception as e:
+            print(f"ジャーナル初期化エラー: {e}")
+        # 取りこぼし回収（起動時・スリープ復帰時・定期）
+        self._manifests = {}  # 正規化ルート -> FolderManifest
+        self._manifests_lock = threading.Lock()
+        self._reconcile_event = threading.Event()
+        self._reconcile_reason = None
+        threading.Thread(target=self._reconcile_loop, name="pdf-reconcile", daemon=True).start()
+
         # グローバル設定オプション
         self.auto_startup = tk.BooleanVar(value=self.config.get('auto_startup', False))
         # 最小化時はトレイに格納（常駐）
@@ -624,6 +2774,7 @@ class AutoPDFWatcherAdvanced:
                 data = json.load(f)
             # 安全なキーのみ適用
             self.watch_folders = data.get('watch_folders', self.watch_folders)
+            self.folder_index.rebuild(self.watch_folders)
             self.auto_startup.set(bool(data.get('auto_startup', self.auto_startup.get())))
             self.minimize_to_tray.set(bool(data.get('minimize_to_tray', self.minimize_to_tray.get())))
             # 反映
@@ -1509,8 +3660,18 @@ class AutoPDFWatcherAdvanced:
             bg="white",
             fg="#666666"
         )
-        self.status_label.pack(pady=(0, 8))
-        
+        self.status_label.pack(pady=(0, 2))
+        # 処理キューの状況（待機数/処理中数）
+        self.queue_label = tk.Label(
+            self.window,
+            text="",
+            font=("Arial", 10),
+            bg="white",
+            fg="#6B7280"
+        )
+        self.queue_label.pack(pady=(0, 8))
+        self._update_queue_status()
+
         # 監視フォルダ設定
         folder_frame = tk.LabelFrame(
             self.window,
@@ -1714,6 +3875,12 @@ class AutoPDFWatcherAdvanced:
             instr = (folder_info.get('custom_classify_prompt') or '').strip()
             has_instr = use_instr and bool(instr)
             settings_info.append("指示:あり" if has_instr else "指示:なし")
+            if folder_info.get('watch_mode') == 'polling':
+                settings_info.append(f"ポーリング{folder_info.get('poll_interval_sec', 30)}s")
+            if int(folder_info.get('priority', 5)) != 5:
+                settings_info.append(f"優先度{folder_info.get('priority')}")
+            if int(folder_info.get('max_concurrency', 0)) > 0:
+                settings_info.append(f"同時{folder_info.get('max_concurrency')}件まで")
             
             settings_text = ", ".join(settings_info) if settings_info else "基本"
             
@@ -1775,14 +3942,80 @@ class AutoPDFWatcherAdvanced:
             }
             
             self.watch_folders.append(new_folder_info)
+            self.folder_index.add(new_folder_info)
             self.update_folder_tree()
             self.save_config()
             self.log_message(f"📁 監視フォルダを追加: {folder}")
             
             # 監視中の場合は動的に監視対象に追加
-            if self.is_watching and hasattr(self, 'observers'):
+            if self.is_watching:
                 self.add_folder_to_active_monitoring(new_folder_info)
     
+    def _ensure_observer(self):
+        """共有Observerを用意（全フォルダで1つを使い回す）"""
+        if self.observer is None:
+            self.observer = Observer()
+            self.observer.start()
+        return self.observer
+
+    def _poll_interval(self, folder_info) -> float:
+        try:
+            return max(2.0, float(folder_info.get('poll_interval_sec', 30)))
+        except Exception:
+            return 30.0
+
+    def _schedule_folder(self, folder_info):
+        """フォルダを監視へ登録（通常=共有Observer / ポーリング=巡回スレッド）。
+        同じ方式で登録済みなら設定のみ差し替え、方式が変わった場合だけ登録し直す。
+        """
+        path = folder_info['path']
+        mode = 'polling' if folder_info.get('watch_mode') == 'polling' else 'native'
+        entry = self._watches.get(path)
+        if entry and entry['mode'] == mode:
+            if mode == 'polling':
+                self.polling_watcher.add(path, self._poll_interval(folder_info))
+            else:
+                entry['handler'].folder_settings = folder_info
+            return False
+        if entry:
+            self._unschedule_folder(path)
+        if mode == 'polling':
+            self.polling_watcher.add(path, self._poll_interval(folder_info))
+            self._watches[path] = {'mode': mode, 'watch': None, 'handler': None}
+        else:
+            event_handler = PDFWatcherHandler(self)
+            event_handler.folder_settings = folder_info
+            watch = self._ensure_observer().schedule(event_handler, path, recursive=True)
+            self._watches[path] = {'mode': mode, 'watch': watch, 'handler': event_handler}
+        return True
+
+    def _unschedule_folder(self, folder_path):
+        entry = self._watches.pop(folder_path, None)
+        if not entry:
+            return False
+        try:
+            if entry['mode'] == 'polling':
+                self.polling_watcher.remove(folder_path)
+            else:
+                self.observer.unschedule(entry['watch'])
+        except Exception:
+            pass
+        return True
+
+    def _on_polled_file(self, file_path):
+        """ポーリングで見つかった新規PDF（処理済みとして台帳にあるものは除外）"""
+        m = self._manifest_containing(file_path)
+        if m and m.is_processed(file_path):
+            return
+        self.watch_new_file(file_path)
+
+    def _update_watching_status(self):
+        if hasattr(self, 'status_label') and self.is_watching:
+            self.status_label.config(
+                text=f"監視中: {len(self._watches)}個のフォルダ",
+                fg="#4CAF50"
+            )
+
     def add_folder_to_active_monitoring(self, folder_info):
         """アクティブな監視セッションに新しいフォルダを追加"""
         try:
@@ -1790,28 +4023,10 @@ class AutoPDFWatcherAdvanced:
                 self.log_message(f"⚠️ フォルダが見つかりません: {folder_info['path']}")
                 return
             
-            # 新しいObserverを作成して追加
-            event_handler = PDFWatcherHandler(self)
-            event_handler.folder_settings = folder_info
-            
-            observer = Observer()
-            observer.schedule(event_handler, folder_info['path'], recursive=True)
-            observer.start()
-            
-            # observers リストに追加
-            if not hasattr(self, 'observers'):
-                self.observers = []
-            self.observers.append(observer)
-            
-            self.log_message(f"📁 監視に追加: {folder_info['path']}")
-            
-            # ステータス更新
-            if hasattr(self, 'status_label'):
-                folder_count = len([f for f in self.watch_folders if f.get('enabled', True) and os.path.exists(f.get('path', ''))])
-                self.status_label.config(
-                    text=f"監視中: {folder_count}個のフォルダ", 
-                    fg="#4CAF50"
-                )
+            if self._schedule_folder(folder_info):
+                self.log_message(f"📁 監視に追加: {folder_info['path']}")
+                self.request_reconcile('フォルダ追加')
+            self._update_watching_status()
                 
         except Exception as e:
             self.log_message(f"❌ フォルダ監視追加エラー: {e}")
@@ -1819,40 +4034,9 @@ class AutoPDFWatcherAdvanced:
     def remove_folder_from_active_monitoring(self, folder_path):
         """アクティブな監視セッションから特定のフォルダを削除"""
         try:
-            if not hasattr(self, 'observers'):
-                return
-            
-            # 該当するObserverを見つけて停止
-            observers_to_remove = []
-            for i, observer in enumerate(self.observers):
-                # Observerが監視している各patへアクセスしてチェック
-                try:
-                    # watchdog のObserver内部の監視パスをチェック
-                    # _watchesからパスを取得
-                    if hasattr(observer, '_watches'):
-                        for watch in observer._watches.values():
-                            if hasattr(watch, 'path') and watch.path == folder_path:
-                                observer.stop()
-                                observer.join(timeout=2)  # 最大2秒待機
-                                observers_to_remove.append(i)
-                                self.log_message(f"📁 監視停止: {folder_path}")
-                                break
-                except Exception:
-                    # フォールバック: パス比較ができない場合は継続
-                    pass
-            
-            # リストから削除（逆順で削除してインデックスの問題を回避）
-            for i in sorted(observers_to_remove, reverse=True):
-                if i < len(self.observers):
-                    self.observers.pop(i)
-            
-            # ステータス更新
-            if hasattr(self, 'status_label'):
-                folder_count = len([f for f in self.watch_folders if f.get('enabled', True) and os.path.exists(f.get('path', ''))])
-                self.status_label.config(
-                    text=f"監視中: {folder_count}個のフォルダ", 
-                    fg="#4CAF50"
-                )
+            if self._unschedule_folder(folder_path):
+                self.log_message(f"📁 監視停止: {folder_path}")
+            self._update_watching_status()
                 
         except Exception as e:
             self.log_message(f"❌ フォルダ監視停止エラー: {e}")
@@ -1874,24 +4058,17 @@ class AutoPDFWatcherAdvanced:
                 self.add_folder_to_active_monitoring(new_folder_info)
                 self.log_message(f"📁 監視有効化: {folder_path}")
             
-            # 有効のまま設定変更の場合：一旦停止して再開始で設定更新
+            # 有効のまま設定変更の場合：ハンドラーの設定だけ差し替え（再登録しない）
             elif old_enabled and new_enabled:
-                self.remove_folder_from_active_monitoring(folder_path)
-                # 少し待ってから再追加
-                self.window.after(100, lambda: self.add_folder_to_active_monitoring(new_folder_info))
+                if folder_path in self._watches:
+                    self._schedule_folder(new_folder_info)
+                else:
+                    self.add_folder_to_active_monitoring(new_folder_info)
                 self.log_message(f"📁 監視設定更新: {folder_path}")
                 
         except Exception as e:
             self.log_message(f"❌ 監視状態更新エラー: {e}")
     
-    def restart_after_settings_change(self):
-        """設定変更後の監視再開"""
-        try:
-            self.log_message("▶️ 設定変更完了、監視を再開...")
-            self.start_monitoring()
-        except Exception as e:
-            self.log_message(f"❌ 監視再開エラー: {e}")
-    
     def configure_selected_folder(self):
         """選択されたフォルダの設定"""
         selection = self.folder_tree.selection()
@@ -1906,19 +4083,14 @@ class AutoPDFWatcherAdvanced:
             if dialog.result:
                 old_folder_info = folder_info.copy()
                 self.watch_folders[index] = dialog.result
+                self.folder_index.add(dialog.result)
                 self.update_folder_tree()
                 self.save_config()
                 self.log_message(f"⚙️ フォルダ設定を更新: {dialog.result['path']}")
                 
-                # 監視中の場合は一時停止して再開（二重監視を防止）
-                if self.is_watching and hasattr(self, 'observers'):
-                    self.log_message("⏸️ 設定変更のため監視を一時停止...")
-                    was_watching = True
-                    self.stop_monitoring()
-                    # 短い遅延の後に再開
-                    threading.Timer(1.0, lambda: self.restart_after_settings_change()).start()
-                else:
-                    was_watching = False
+                # 監視中の場合は該当フォルダの登録だけを更新（Observerは止めない）
+                if self.is_watching:
+                    self.update_folder_monitoring(old_folder_info, dialog.result)
         else:
             messagebox.showwarning("警告", "設定するフォルダを選択してください")
     
@@ -1931,11 +4103,12 @@ class AutoPDFWatcherAdvanced:
             
             result = messagebox.askyesno("確認", f"以下のフォルダを削除しますか？\n\n{folder_info['path']}")
             if result:
-                # 監視中の場合は該当するObserverを停止
-                if self.is_watching and hasattr(self, 'observers'):
+                # 監視中の場合は該当フォルダの登録を解除
+                if self.is_watching:
                     self.remove_folder_from_active_monitoring(folder_info['path'])
                 
                 self.watch_folders.pop(index)
+                self.folder_index.remove(folder_info['path'])
                 self.update_folder_tree()
                 self.save_config()
                 self.log_message(f"🗑️ 監視フォルダを削除: {folder_info['path']}")
@@ -1948,7 +4121,11 @@ class AutoPDFWatcherAdvanced:
             result = messagebox.askyesno("確認", "全ての監視フォルダを削除しますか？")
             if result:
                 folder_count = len(self.watch_folders)
+                if self.is_watching:
+                    for folder_info in self.watch_folders:
+                        self.remove_folder_from_active_monitoring(folder_info['path'])
                 self.watch_folders.clear()
+                self.folder_index.clear()
                 self.update_folder_tree()
                 self.save_config()
                 self.log_message(f"🧹 全ての監視フォルダを削除（{folder_count}個）")
@@ -1978,18 +4155,9 @@ class AutoPDFWatcherAdvanced:
             return
         
         try:
-            # フォルダごとにObserverを作成
-            self.observers = []
-            
+            # 共有Observerにフォルダごとのwatchを登録
             for folder_info in valid_folders:
-                event_handler = PDFWatcherHandler(self)
-                # フォルダ設定をハンドラーに渡す
-                event_handler.folder_settings = folder_info
-                
-                observer = Observer()
-                observer.schedule(event_handler, folder_info['path'], recursive=True)
-                observer.start()
-                self.observers.append(observer)
+                self._schedule_folder(folder_info)
                 self.log_message(f"📁 監視開始: {folder_info['path']}")
             
             self.is_watching = True
@@ -2008,6 +4176,9 @@ class AutoPDFWatcherAdvanced:
             )
             
             self.log_message(f"🔄 {len(valid_folders)}個のフォルダの監視を開始しました")
+            # 前回の未完了ジョブを再開し、停止中に置かれたファイルを回収
+            self._resume_journal_jobs()
+            self.request_reconcile('起動')
             
             self.config['auto_start_monitoring'] = True
             self.save_config()
@@ -2018,13 +4189,17 @@ class AutoPDFWatcherAdvanced:
     
     def stop_watching(self):
         """監視停止"""
-        if self.observers and self.is_watching:
-            for observer in self.observers:
-                observer.stop()
-                observer.join()
-            
-            self.observers.clear()
+        if self.is_watching:
+            # 全watchを一括解除（各エミッタを先に全停止してからjoinするため直列待ちにならない）
+            try:
+                if self.observer is not None:
+                    self.observer.unschedule_all()
+            except Exception:
+                pass
+            self.polling_watcher.clear()
+            self._watches.clear()
             self.is_watching = False
+            self._flush_manifests()
             
             try:
                 self.btn_start.state(['!disabled'])
@@ -2047,20 +4222,282 @@ class AutoPDFWatcherAdvanced:
     def stop_watching_from_tray(self):
         """トレイメニューから監視停止"""
         self.stop_watching()
-    
+
+    def enqueue_file(self, file_path, delay=0.0, priority='normal'):
+        """PDFを処理キューへ投入（満杯時は空きが出るまで呼び出し側を待たせる）"""
+        try:
+            if self.job_queue.is_full():
+                if not self._queue_full_logged:
+                    self._queue_full_logged = True
+                    self.log_message(f"⏳ 処理キューが満杯です（{self.job_queue.capacity}件）。空きを待っています...")
+            else:
+                self._queue_full_logged = False
+            settings = self.folder_index.lookup(os.path.dirname(file_path))
+            folder = settings.get('path', '') if settings else ''
+            if self.job_queue.submit(file_path, delay=delay, priority=priority, folder=folder):
+                self._journal(file_path, 'queued', priority=priority, folder=folder)
+            else:
+                self.log_message(f"⚠️ 処理キューに投入できませんでした: {os.path.basename(file_path)}")
+        except Exception as e:
+            self.log_message(f"❌ キュー投入エラー: {e}")
+
+    def watch_new_file(self, file_path, priority='normal', quiet=False) -> bool:
+        """新規PDFの入口。自分が出力したファイルは無視し、完了待ちへ登録する。"""
+        if self._is_self_produced(file_path):
+            return False
+        if self.stability_monitor.add(file_path, priority=priority):
+            if not quiet:
+                self.log_message(f"新しいPDFを検出: {os.path.basename(file_path)}")
+            return True
+        return False
+
+    def _mark_self_produced(self, path, ttl=60.0):
+        """リネーム/移動で自分が生成したパスを一定時間登録（監視イベントの自己反応を防ぐ）"""
+        key = os.path.normcase(os.path.abspath(path))
+        with self._self_produced_lock:
+            self._self_produced[key] = time.monotonic() + ttl
+
+    def _is_self_produced(self, path) -> bool:
+        key = os.path.normcase(os.path.abspath(path))
+        now = time.monotonic()
+        with self._self_produced_lock:
+            for k in [k for k, exp in self._self_produced.items() if exp <= now]:
+                del self._self_produced[k]
+            return key in self._self_produced
+
+    def _folder_policy(self, folder):
+        """キューの公平配分用: フォルダの (重み, 同時処理上限) を返す"""
+        settings = self.folder_index.lookup(folder) if folder else None
+        if not settings:
+            return 5, 0
+        try:
+            weight = min(10, max(1, int(settings.get('priority', 5))))
+        except Exception:
+            weight = 5
+        try:
+            cap = max(0, int(settings.get('max_concurrency', 0)))
+        except Exception:
+            cap = 0
+        return weight, cap
+
+    def _on_file_ready(self, file_path, waited, priority='normal'):
+        """書き込み完了を確認できたファイルをキューへ"""
+        if priority != 'low':
+            self.log_message(f"⏱ 書き込み完了を確認（待ち {waited:.1f}s）: {os.path.basename(file_path)}")
+        self.enqueue_file(file_path, priority=priority)
+
+    def _on_file_not_ready(self, file_path, waited):
+        self.log_message(f"⚠️ 書き込み完了を確認できませんでした（{waited:.0f}s経過）: {os.path.basename(file_path)}")
+
+    def _retry_when_stable(self, file_path) -> bool:
+        """読み込み失敗時、書き込み途中の可能性があれば完了検出からやり直す（最大2回）"""
+        try:
+            count = self._open_retries.get(file_path, 0)
+            if count >= 2 or not os.path.exists(file_path):
+                self._open_retries.pop(file_path, None)
+                return False
+            self._open_retries[file_path] = count + 1
+            self.log_message(f"🔁 読み込みに失敗したため書き込み完了を再確認します: {os.path.basename(file_path)}")
+            self.stability_monitor.add(file_path)
+            return True
+        except Exception:
+            return False
+
+    def _run_job(self, file_path):
+        """ワーカーから呼ばれる1ファイル分の処理（結果を台帳へ記録）"""
+        new_path = None
+        error = None
+        try:
+            new_path = self.process_new_file(file_path)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            if new_path:
+                # 失敗（例外・None・安定待ちへの差し戻し）は未処理のまま残し、再走査で拾い直す
+                self._record_processed(file_path, new_path)
+                self._journal(file_path, 'done', new_path=new_path)
+            else:
+                self._journal(file_path, 'failed', error=error)
+                if file_path not in self._open_retries:
+                    # 書き込み完了待ちへの差し戻しは失敗に数えない
+                    self._record_failed(file_path)
+
+    def _record_failed(self, file_path):
+        """失敗を台帳へ（取りこぼし回収は待ち時間を延ばしながら再投入し、上限回数で諦める）"""
+        try:
+            m = self._manifest_containing(file_path)
+            if not m:
+                return
+            failures = m.mark_failed(file_path)
+            if failures == m.MAX_FAILURES:
+                self.log_message(
+                    f"⛔ {os.path.basename(file_path)}: {failures}回続けて処理に失敗したため、自動での再処理を停止します"
+                    f"（ファイルを更新すると再開）"
+                )
+        except Exception as e:
+            print(f"台帳記録エラー: {e}")
+
+    def _journal(self, file_path, state, **fields):
+        try:
+            if self.journal:
+                self.journal.record(file_path, state, **fields)
+        except Exception:
+            pass
+
+    def _resume_journal_jobs(self):
+        """前回終了時に未完了だったジョブを再投入（初回の監視開始時に1度だけ）"""
+        if self._journal_resumed or not self.journal:
+            return
+        self._journal_resumed = True
+        def _resume():
+            try:
+                jobs = self.journal.unfinished()
+            except Exception as e:
+                self.log_message(f"⚠️ ジャーナル読み込みエラー: {e}")
+                return
+            resumed = 0
+            for path, state, priority, folder, attempts in jobs:
+                if (attempts or 0) >= 3:
+                    # 処理中に毎回落ちるファイルで再起動ループにならないよう打ち切る
+                    self._journal(path, 'failed', error=f'{attempts}回処理中に中断されたため再開しません')
+                    self.log_message(f"⚠️ 処理中の中断が続いたため再開しません: {os.path.basename(path)}")
+                elif os.path.exists(path):
+                    if self.watch_new_file(path, priority=priority or 'normal', quiet=True):
+                        resumed += 1
+                else:
+                    self._journal(path, 'failed', error='再開時に元ファイルが見つかりません')
+            if resumed:
+                self.log_message(f"♻️ 前回未完了だった{resumed}件の処理を再開します")
+        threading.Thread(target=_resume, daemon=True).start()
+
+    # ---------- 取りこぼし回収（台帳との差分走査） ----------
+    def _manifest_for_folder(self, folder_path):
+        root = os.path.normpath(folder_path)
+        key = os.path.normcase(root)
+        with self._manifests_lock:
+            m = self._manifests.get(key)
+            if m is None:
+                digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+                store = os.path.join(self._get_appdata_dir(), 'manifests', f'{digest}.json')
+                m = FolderManifest(root, store)
+                m.load()
+                self._manifests[key] = m
+            return m
+
+    def _manifest_containing(self, file_path):
+        """ファイルを含む台帳のうち最も深いもの"""
+        with self._manifests_lock:
+            found = [m for m in self._manifests.values() if m.contains(file_path)]
+        return max(found, key=lambda m: len(m.root)) if found else None
+
+    def _record_processed(self, original_path, new_path):
+        """処理に成功した結果を台帳へ（元ファイルは処理済み/消去、出力は処理済みとして登録）"""
+        try:
+            m = self._manifest_containing(original_path)
+            if m:
+                m.mark(original_path, processed=True)
+            if new_path:
+                m2 = self._manifest_containing(new_path)
+                if m2:
+                    m2.mark(new_path, processed=True)
+        except Exception as e:
+            print(f"台帳記録エラー: {e}")
+
+    def _flush_manifests(self):
+        with self._manifests_lock:
+            manifests = list(self._manifests.values())
+        for m in manifests:
+            m.save()
+
+    def request_reconcile(self, reason):
+        """取りこぼし回収の走査を要求（実行はバックグラウンド）"""
+        self._reconcile_reason = reason
+        self._reconcile_event.set()
+
+    def _reconcile_loop(self):
+        tick = 5.0
+        last_wall = time.time()
+        last_run = time.monotonic()
+        last_flush = time.monotonic()
+        while True:
+            triggered = self._reconcile_event.wait(tick)
+            self._reconcile_event.clear()
+            now_wall = time.time()
+            # 壁時計が大きく飛んだ = スリープ/休止からの復帰
+            resumed = (now_wall - last_wall) > tick * 6
+            last_wall = now_wall
+            try:
+                if time.monotonic() - last_flush >= tick:
+                    self._flush_manifests()
+                    last_flush = time.monotonic()
+                if not self.is_watching:
+                    continue
+                try:
+                    interval = max(1.0, float(self.config.get('reconcile_interval_min', 10))) * 60
+                except Exception:
+                    interval = 600.0
+                due = time.monotonic() - last_run >= interval
+                if triggered or resumed or due:
+                    reason = self._reconcile_reason if triggered else ('スリープ復帰' if resumed else '定期')
+                    self._reconcile_reason = None
+                    self._reconcile_once(reason or '定期')
+                    last_run = time.monotonic()
+            except Exception as e:
+                print(f"回収走査エラー: {e}")
+
+    def _reconcile_once(self, reason):
+        """監視中の各フォルダを台帳と突き合わせ、未処理PDFを低優先度で投入"""
+        started = time.monotonic()
+        total = 0
+        for folder_path in list(self._watches.keys()):
+            m = self._manifest_for_folder(folder_path)
+            first = not m.has_baseline
+            candidates = m.scan()
+            if first:
+                self.log_message(f"📒 台帳を作成しました（既存PDFは処理済み扱い）: {folder_path}")
+            for path in candidates:
+                if self.watch_new_file(path, priority='low', quiet=True):
+                    total += 1
+            m.save()
+        elapsed = time.monotonic() - started
+        if total:
+            self.log_message(f"🔍 未処理PDFを{total}件検出（{reason}・{elapsed:.1f}s）→ 低優先度で処理します")
+        else:
+            print(f"回収走査完了（{reason}）: 未処理なし {elapsed:.2f}s")
+
+    def _schedule_queue_status(self):
+        """ワーカースレッドから呼ばれる。表示更新はメインスレッドへまとめて委譲。"""
+        if self._queue_status_pending:
+            return
+        self._queue_status_pending = True
+        try:
+            self.window.after(200, self._update_queue_status)
+        except Exception:
+            self._queue_status_pending = False
+
+    def _update_queue_status(self):
+        self._queue_status_pending = False
+        try:
+            pending, in_flight = self.job_queue.depth()
+            self.queue_label.config(
+                text=f"処理待ち: {pending}件 / 処理中: {in_flight}件（最大{self.job_queue.workers}件同時）"
+            )
+        except Exception:
+            pass
+
     def process_new_file(self, file_path):
         """新しいPDFファイルを処理（フォルダ別設定対応）"""
+        pdoc = None
+        images = []
+        profiling = self._start_memory_profiling()
         try:
             filename = os.path.basename(file_path)
             folder_path = os.path.dirname(file_path)
             folder_name = os.path.basename(folder_path)
             
-            # ファイルが属するフォルダの設定を取得
-            folder_settings = None
-            for folder_info in self.watch_folders:
-                if folder_path.startswith(folder_info['path']):
-                    folder_settings = folder_info
-                    break
+            # ファイルが属するフォルダの設定を取得（最も具体的な登録フォルダを優先）
+            folder_settings = self.folder_index.lookup(folder_path)
             
             if not folder_settings:
                 folder_settings = {
@@ -2076,11 +4513,22 @@ class AutoPDFWatcherAdvanced:
                 self.log_message(f"❌ ファイルが見つかりません: {filename}")
                 return
             
-            # PDFを画像に変換（先頭2ページまで）
-            images = self.pdf_to_images(file_path, max_pages=2)
+            # PDFは1回だけ読み込み、以降の各段（画像化・テキスト・レイアウト）で共有
+            self._journal(file_path, 'rendering')
+            try:
+                pdoc = ParsedDocument(file_path, farm=self.render_farm, governor=self.memory_governor)
+            except Exception as e:
+                print(f"PDF読み込みエラー: {e}")
+                pdoc = None
+            # 先頭2ページの画像ハンドル（Visionが必要とした時だけレンダリング）
+            colorspace = folder_settings.get('render_colorspace', 'auto')
+            images = self.pdf_to_images(pdoc, max_pages=2, lazy=True, colorspace=colorspace) if pdoc else []
             if not images:
+                if self._retry_when_stable(file_path):
+                    return
                 self.log_message(f"❌ PDF変換失敗: {filename}")
                 return
+            self._open_retries.pop(file_path, None)
             
             prompt_override = None
             try:
@@ -2089,13 +4537,18 @@ class AutoPDFWatcherAdvanced:
                     prompt_override = c if c else None
             except Exception:
                 prompt_override = (folder_settings.get('custom_classify_prompt') or None)
-            extracted_text = self.extract_text_from_pdf(file_path, max_pages=2, max_chars=4000)
+            extracted_text = self.extract_text_from_pdf(pdoc, max_pages=2, max_chars=4000)
+            # テキスト層の品質（壊れたOCR層ならテキスト経路を使わず画像で判定する）
+            text_ok, first_page_ok = self.assess_text_quality(pdoc, filename)
 
             # まず文書種別を軽く判定（登記事項系の特別処理用）
             self.log_message(f"🔎 種別判定: {filename}")
+            self._journal(file_path, 'classifying')
             preset_key_for_labels = folder_settings.get('prompt_preset', 'auto')
-            if extracted_text and len(extracted_text) >= 200:
-                doc_type = self.classify_with_text(extracted_text, prompt_override=prompt_override, preset_key=preset_key_for_labels)
+            if text_ok and extracted_text and len(extracted_text) >= 200:
+                doc_type = self.classify_locally(extracted_text, preset_key_for_labels, prompt_override, filename)
+                if not doc_type:
+                    doc_type = self.classify_with_text(extracted_text, prompt_override=prompt_override, preset_key=preset_key_for_labels)
             else:
                 doc_type = self.classify_with_vision(images, prompt_override=prompt_override, preset_key=preset_key_for_labels)
             doc_type = (doc_type or '').strip()
@@ -2109,16 +4562,17 @@ class AutoPDFWatcherAdvanced:
             # 宛名・日付はオプションで抽出
             names_info = {'surname': None, 'given_name': None, 'company_name': None}
             if folder_settings.get('include_names', False):
-                names_info = self.extract_names_and_companies(images[0])
+                local_names = self.extract_names_locally(pdoc, filename) if first_page_ok else None
+                names_info = local_names or self.extract_names_and_companies(self._region_image(images[0], 'header'))
             document_date = None
             if folder_settings.get('include_date', False):
                 document_date = datetime.now().strftime("%Y%m%d")
 
             # 登記事項証明系なら、不動産情報を抽出して専用命名
-            registry_keywords = ['登記事項証明書', '登記情報', '登記簿', '全部事項証明書', '現在事項証明書', '建物事項証明書', '土地登記', '建物登記', '不動産登記']
-            if any(k in doc_type for k in registry_keywords):
+            if self.keyword_matcher.has(doc_type, 'registry'):
                 self.log_message("🏷 登記系書類と判定 → 不動産情報を抽出")
-                property_info = self.extract_property_info(images[0], doc_type)
+                property_info = self.extract_property_info(self._region_image(images[0], 'registry'), doc_type)
+                self._journal(file_path, 'renaming')
                 # ファイルリネーム（document_typeは固定で登記事項証明書を採用）
                 new_path = self.rename_file(
                     file_path, '登記事項証明書', names_info, document_date, property_info, folder_settings
@@ -2127,16 +4581,16 @@ class AutoPDFWatcherAdvanced:
                 # 主: 1ページ目のタイトル重視 → 失敗時は全体から推定
                 self.log_message(f"🧠 AI自由命名: {filename}")
                 # レイアウト優先：上部の大きな文字を優先してタイトル候補に
-                layout_title = self.extract_layout_title(file_path)
+                layout_title = self.extract_layout_title(pdoc) if first_page_ok else None
                 base_name = layout_title
-                if not base_name:
-                    first_text = self.extract_text_from_pdf(file_path, max_pages=1, max_chars=1000)
+                if not base_name and first_page_ok:
+                    first_text = self.extract_text_from_pdf(pdoc, max_pages=1, max_chars=1000)
                     if first_text and len(first_text) >= 40:
                         base_name = self.ai_name_from_text(first_text, prompt_override)
                 if not base_name:
-                    base_name = self.ai_name_from_vision([images[0]], prompt_override)
+                    base_name = self.ai_name_from_vision([self._region_image(images[0], 'header')], prompt_override)
                 if not base_name:
-                    if extracted_text and len(extracted_text) >= 120:
+                    if text_ok and extracted_text and len(extracted_text) >= 120:
                         base_name = self.ai_name_from_text(extracted_text, prompt_override)
                     else:
                         base_name = self.ai_name_from_vision(images, prompt_override)
@@ -2166,6 +4620,7 @@ class AutoPDFWatcherAdvanced:
                         final_name += f"_{document_date}"
 
                 document_type = self.sanitize_filename(final_name)
+                self._journal(file_path, 'renaming')
                 new_path = self.rename_file(
                     file_path, document_type, None, None, None, folder_settings
                 )
@@ -2183,9 +4638,198 @@ class AutoPDFWatcherAdvanced:
                     pass
             else:
                 self.log_message(f"❌ リネーム失敗: {filename}")
+            return new_path
                 
         except Exception as e:
             self.log_message(f"❌ 処理エラー: {filename} - {e}")
+        finally:
+            self._count_renders(images)
+            images = None
+            self._report_memory(file_path, pdoc, profiling)
+            if pdoc is not None:
+                pdoc.close()
+
+    def assess_text_quality(self, pdoc, filename) -> tuple[bool, bool]:
+        """先頭2ページのテキスト層を採点してログに出す。(全体が使えるか, 1ページ目が使えるか)"""
+        try:
+            threshold = float(self.config.get('text_quality_threshold', 0.5))
+        except Exception:
+            threshold = 0.5
+        try:
+            page_scores = []
+            for i in range(min(pdoc.page_count, 2)):
+                score, detail = TextQualityScorer.score(pdoc.page_text(i))
+                page_scores.append((score, detail))
+            if not page_scores:
+                return False, False
+            total_chars = sum(d['chars'] for _, d in page_scores)
+            if total_chars == 0:
+                self.log_message(f"📝 テキスト層なし: {filename} → 画像で判定")
+                return False, False
+            # 短すぎて判定できないページ（表紙など）は除外し、判定できたページだけで評価する
+            judged = [(sc, d) for sc, d in page_scores if sc is not None]
+            judged_chars = sum(d['chars'] for _, d in judged)
+            overall = sum(sc * d['chars'] for sc, d in judged) / judged_chars if judged_chars else None
+            first_score, first = page_scores[0]
+            text_ok = overall is None or overall >= threshold
+            first_page_ok = first_score is None or first_score >= threshold
+            if first_score is None:
+                first_note = f"1ページ目 {first['chars']}文字・判定対象外"
+            else:
+                first_note = (f"1ページ目 {first_score:.2f}: "
+                              f"有効{first.get('valid', 0):.0%} 化け{first.get('bad', 0):.0%} 辞書語{first.get('dict', 0):.0%} "
+                              f"平均長{first.get('avg_len', 0):.1f}")
+            overall_note = f"{overall:.2f}" if overall is not None else "判定対象外"
+            self.log_message(
+                f"📝 テキスト品質: {filename} {overall_note}（{first_note}）→ {'テキスト' if text_ok else '画像'}で判定"
+            )
+            return text_ok, first_page_ok
+        except Exception as e:
+            print(f"テキスト品質判定エラー: {e}")
+            return True, True
+
+    def classify_locally(self, text, preset_key, prompt_override, filename) -> str | None:
+        """ローカル分類で確信度がしきい値以上なら種別を返す（分類APIを省略）。
+        一部はAPIでも分類して一致率を記録する。独自の分類指示があるフォルダでは使わない。
+        """
+        if prompt_override or not self.config.get('local_classifier_enabled', True):
+            return None
+        try:
+            threshold = float(self.config.get('local_classifier_threshold', 0.75))
+            sample_rate = float(self.config.get('local_classifier_sample_rate', 0.1))
+        except Exception:
+            threshold, sample_rate = 0.75, 0.1
+        try:
+            labels = self.build_label_set(preset_key)
+            label, confidence, _ = LocalDocumentClassifier.classify(text, labels)
+        except Exception as e:
+            print(f"ローカル分類エラー: {e}")
+            return None
+        stats_ = self._local_classifier_stats
+        with self._local_classifier_lock:
+            stats_['attempts'] += 1
+            hit = bool(label) and confidence >= threshold
+            if hit:
+                stats_['hits'] += 1
+        if not hit:
+            return None
+        self.log_message(f"⚡ ローカル分類: {filename} → {label}（確信度 {confidence:.2f}・API省略）")
+        if random.random() < sample_rate:
+            # 抜き取りでAPIとも照合（一致率の把握用。食い違えばAPIの結果を採用）
+            api_label = self.normalize_document_type(
+                self.classify_with_text(text, prompt_override=None, preset_key=preset_key))
+            agree = api_label == label
+            with self._local_classifier_lock:
+                stats_['sampled'] += 1
+                stats_['agreed'] += int(agree)
+                summary = (f"命中率 {stats_['hits'] / stats_['attempts']:.0%}（{stats_['hits']}/{stats_['attempts']}）, "
+                           f"API一致率 {stats_['agreed'] / stats_['sampled']:.0%}（{stats_['agreed']}/{stats_['sampled']}）")
+            self.log_message(f"🧪 ローカル分類の照合: API={api_label} {'一致' if agree else '不一致'} / {summary}")
+            if not agree and api_label not in ('PDF文書', ''):
+                return api_label
+        return label
+
+    def _start_memory_profiling(self):
+        """設定 memory_profiling が有効なら tracemalloc を開始し、計測用のジョブキーを返す（無効なら None）。
+        ピークはプロセス全体で1つなので、他に計測中のジョブが無いときだけリセットする。
+        """
+        if not self.config.get('memory_profiling', False):
+            return None
+        try:
+            key = object()
+            with self._profiling_lock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                if self._profiling_jobs:
+                    # 同時処理中のジョブがあれば、どちらのピークもジョブ単位では扱えない
+                    for other in self._profiling_jobs:
+                        self._profiling_jobs[other] = True
+                    self._profiling_jobs[key] = True
+                else:
+                    tracemalloc.reset_peak()
+                    self._profiling_jobs[key] = False
+            return key
+        except Exception:
+            return None
+
+    def _report_memory(self, file_path, pdoc, profiling):
+        """ジョブのメモリ使用状況をログに出す（memory_profiling 有効時のみ）"""
+        if profiling is None:
+            return
+        with self._profiling_lock:
+            overlapped = self._profiling_jobs.pop(profiling, True)
+            _, peak = tracemalloc.get_traced_memory()
+        if pdoc is None:
+            return
+        try:
+            mb = 1024 * 1024
+            if overlapped:
+                heap = f"Pythonヒープのピーク {peak / mb:.1f}MB（プロセス全体・同時処理中のジョブを含む）"
+            else:
+                heap = f"Pythonヒープのピーク {peak / mb:.1f}MB（このジョブ単独）"
+            line = f"🧮 メモリ: {os.path.basename(file_path)} 画像バッファ最大 {pdoc.peak_reserved_bytes / mb:.1f}MB, {heap}"
+            if self.memory_governor:
+                used, budget = self.memory_governor.usage()
+                line += (f", 予算 {used / mb:.0f}/{budget / mb:.0f}MB"
+                         f"（全体ピーク {self.memory_governor.peak_bytes / mb:.0f}MB, 待機 {self.memory_governor.waits}回）")
+            self.log_message(line)
+        except Exception as e:
+            print(f"メモリ計測エラー: {e}")
+
+    def _region_image(self, image, region):
+        """宛名・タイトル・表題部など用途別の注目領域に切り出す（設定で無効化可・失敗時は全体）"""
+        if not isinstance(image, LazyPageImage) or not self.config.get('roi_crops_enabled', True):
+            return image
+        defaults = {'header': 0.4, 'registry': 0.55}
+        try:
+            fraction = float(self.config.get(f'roi_{region}_fraction', defaults.get(region, 0.5)))
+            return image.region(region, fraction)
+        except Exception as e:
+            print(f"注目領域の切り出しエラー: {e}")
+            return image
+
+    def _image_block(self, image) -> dict:
+        """Vision呼び出し用の画像ブロック。
+        遅延ハンドルならジョブ内キャッシュからエンコード済みのものを使い回す。
+        """
+        fmt = str(self.config.get('vision_image_format', 'jpeg')).lower()
+        if fmt not in ('jpeg', 'webp', 'png'):
+            fmt = 'jpeg'
+        try:
+            quality = int(self.config.get('vision_image_quality', 85))
+        except Exception:
+            quality = 85
+        if isinstance(image, LazyPageImage):
+            try:
+                return image.content_block(fmt, quality)
+            except Exception as e:
+                print(f"画像エンコード（キャッシュ）エラー: {e}")
+                image = image.get()
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": "image/png",
+                "data": base64.b64encode(buffer.getvalue()).decode('utf-8')
+            }
+        }
+
+    def _count_renders(self, images):
+        """遅延ハンドルのうち実際に画像化されたページ数を集計する"""
+        handles = [h for h in (images or []) if isinstance(h, LazyPageImage)]
+        if not handles:
+            return
+        rendered = sum(1 for h in handles if h.rendered)
+        with self._render_stats_lock:
+            self._render_stats['pages'] += len(handles)
+            self._render_stats['rendered'] += rendered
+            total, done = self._render_stats['pages'], self._render_stats['rendered']
+        if rendered < len(handles):
+            self.log_message(
+                f"🖼 画像化を省略: {len(handles) - rendered}/{len(handles)}ページ（累計 {total - done}/{total}ページ省略）"
+            )
 
     def extract_layout_title(self, pdf_path: str) -> str | None:
         """1ページ目のレイアウトからタイトル候補を抽出。
@@ -2193,63 +4837,36 @@ class AutoPDFWatcherAdvanced:
         - 大きめの中では画面上部（yが小さい）を優先
         - ノイズ（あまりに短い/英数字のみ等）を除外
         """
+        doc, owned = None, False
         try:
-            doc = fitz.open(pdf_path)
-            if len(doc) == 0:
+            doc, owned = self._open_document(pdf_path)
+            if doc.page_count == 0:
                 return None
-            page = doc[0]
-            info = page.get_text('dict')
-            lines_agg = []  # (y0, rep_size, full_line_text)
-            for block in info.get('blocks', []):
-                for line in block.get('lines', []):
-                    spans = line.get('spans', []) or []
-                    if not spans:
-                        continue
-                    # line bbox は spans/bbox から推測
-                    y0s, sizes, texts = [], [], []
-                    for span in spans:
-                        text = (span.get('text') or '')
-                        if not text.strip():
-                            continue
-                        texts.append(text)
-                        sizes.append(float(span.get('size') or 0))
-                        bbox = span.get('bbox') or [0,0,0,0]
-                        y0s.append(bbox[1])
-                    if not texts:
-                        continue
-                    full_text = ''.join(texts).strip()
-                    # クリーンアップ
-                    full_text = re.sub(r'[\s\u3000]+', ' ', full_text)
-                    tclean = re.sub(r'\s+', '', full_text)
-                    if len(tclean) < 2:
-                        continue
-                    if re.fullmatch(r'[\W_]+', tclean):
-                        continue
-                    if re.fullmatch(r'[0-9\-–—/\.]+', tclean):
-                        continue
-                    y0 = min(y0s) if y0s else 0.0
-                    # 表示サイズの代表値は最大（見出しを優先）
-                    rep_size = max(sizes) if sizes else 0.0
-                    lines_agg.append((y0, rep_size, full_text))
+            if doc.layout_title_cache is not None:
+                return doc.layout_title_cache or None
+            lines = []  # (y0, x0, x1, size, flags, full_line_text)
+            # 行の位置・最大サイズはジョブ共有のスパン表から（本文テキストと同じ1回の解析結果）
+            for y0, _, rep_size, full_text, x0, x1, flags in doc.page_lines(0):
+                # クリーンアップ
+                full_text = re.sub(r'[\s\u3000]+', ' ', full_text)
+                tclean = re.sub(r'\s+', '', full_text)
+                if len(tclean) < 2:
+                    continue
+                if re.fullmatch(r'[\W_]+', tclean):
+                    continue
+                if re.fullmatch(r'[0-9\-–—/\.]+', tclean):
+                    continue
+                lines.append((y0, x0, x1, rep_size, flags, full_text))
 
-            if not lines_agg:
+            # 大きめ文字の中で最上部（yが小）を採用（無ければ上位サイズ10件から最上部）
+            selected = LayoutTitleEngine(lines).select()
+            if not selected:
+                doc.layout_title_cache = ''
                 return None
-            sizes = [s for _, s, _ in lines_agg]
-            med = stats.median(sizes)
-            thr = max(12.0, med * 1.25)
-            large = [(y, sz, tx) for (y, sz, tx) in lines_agg if sz >= thr]
-            if not large:
-                # 代替: 上位サイズ10件から最上部を優先
-                topN = sorted(lines_agg, key=lambda t: t[1], reverse=True)[:10]
-                cand = sorted(topN, key=lambda t: (t[0], -t[1]))[0]
-                title = cand[2]
-                # 行継続（ハイフン区切りや同サイズで直下行が続く場合）
-                title = self._maybe_join_next_line(title, cand, lines_agg)
-            else:
-                # 大きめ文字の中で最上部（yが小）を採用
-                cand = sorted(large, key=lambda t: (t[0], -t[1]))[0]
-                title = cand[2]
-                title = self._maybe_join_next_line(title, cand, lines_agg)
+            title, next_text = selected
+            # 行継続（ハイフン区切りや同サイズで直下行が続く場合）
+            if next_text:
+                title = self._join_continuation(title, next_text)
             # 軽クリーニング
             title = title.strip().splitlines()[0]
             title = re.sub(r'[\s　]+', ' ', title)
@@ -2259,26 +4876,86 @@ class AutoPDFWatcherAdvanced:
             # 英単語途中の不自然な空白を除去（例: Organizat ion → Organization）
             title = re.sub(r'(?<=[a-z])\s+(?=[a-z])', '', title)
             title = self.sanitize_filename(title)
-            doc.close()
             # 極端に短い場合は見なさない
-            return title if len(title) >= 2 else None
+            title = title if len(title) >= 2 else None
+            doc.layout_title_cache = title or ''
+            return title
         except Exception:
-            try:
-                doc.close()
-            except Exception:
-                pass
             return None
+        finally:
+            if owned:
+                doc.close()
+
+    @staticmethod
+    def run_layout_benchmark(directory: str | None = None, rounds: int = 5):
+        """--bench-layout [フォルダ]: タイトル行選択の従来実装と LayoutTitleEngine を比較して表示する。
+        フォルダ内のPDF（1ページ目）を使い、指定が無ければ擬似的な高密度ページ（帳票・登記事項）を生成する。
+        """
+        corpus = []
+        if directory:
+            for name in sorted(os.listdir(directory)):
+                if not name.lower().endswith('.pdf'):
+                    continue
+                try:
+                    with ParsedDocument(os.path.join(directory, name)) as doc:
+                        if doc.page_count:
+                            corpus.append((name, [(ln[0], ln[4], ln[5], ln[2], ln[6], ln[3]) for ln in doc.page_lines(0)]))
+                except Exception as e:
+                    print(f"読み込み失敗: {name} - {e}")
+        else:
+            rng = random.Random(42)
+            for p in range(20):
+                lines = [(40.0, 200.0, 330.0, 18.0, 16, '固定資産評価'), (40.0, 336.0, 420.0, 18.0, 16, '証明書')]
+                y = 80.0
+                while len(lines) < 3000:
+                    x = 30.0
+                    for _ in range(rng.randrange(3, 8)):
+                        w = rng.uniform(20, 80)
+                        lines.append((y + rng.uniform(-0.3, 0.3), x, x + w, rng.choice((7.0, 8.0, 9.0, 10.0, 12.0, 14.0)), 0,
+                                      f"項目{rng.randrange(10000)}"))
+                        x += w + rng.uniform(4, 30)
+                    y += rng.uniform(9, 12)
+                rng.shuffle(lines)
+                corpus.append((f"擬似ページ{p + 1}", lines))
+        if not corpus:
+            print("対象のPDFがありません")
+            return
+
+        def legacy(lines):
+            # 変更前: 中央値 → 全体の並べ替え → 候補ごとに直下行を全件から再抽出して並べ替え
+            agg = [(t[0], t[3], t[5]) for t in lines]
+            med = stats.median([sz for _, sz, _ in agg])
+            thr = max(12.0, med * 1.25)
+            large = [t for t in agg if t[1] >= thr]
+            if not large:
+                top = sorted(agg, key=lambda t: t[1], reverse=True)[:10]
+                cand = sorted(top, key=lambda t: (t[0], -t[1]))[0]
+            else:
+                cand = sorted(large, key=lambda t: (t[0], -t[1]))[0]
+            below = [t for t in agg if t[0] > cand[0] and abs(t[1] - cand[1]) <= max(1.0, cand[1] * 0.1)]
+            nxt = sorted(below, key=lambda t: t[0])[0][2] if below else None
+            return cand[2], nxt
 
-    def _maybe_join_next_line(self, title: str, cand: tuple, lines_agg: list[tuple]) -> str:
-        """候補行の直下行が同等サイズで続きなら結合（ハイフン改行や単語分割対策）。"""
+        def measure(func):
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                results = [func(lines) for _, lines in corpus]
+            return (time.perf_counter() - t0) * 1000 / rounds / len(corpus), results
+
+        old_ms, old_results = measure(legacy)
+        new_ms, new_results = measure(lambda lines: LayoutTitleEngine(lines).select())
+        total_lines = sum(len(lines) for _, lines in corpus)
+        print(f"タイトル行選択ベンチマーク: {len(corpus)}ページ, 平均 {total_lines // len(corpus)}行/ページ, {rounds}回平均")
+        print(f"  従来実装        : {old_ms:8.2f} ms/ページ")
+        print(f"  新エンジン      : {new_ms:8.2f} ms/ページ")
+        same = sum(1 for a, b in zip(old_results, new_results) if a[0] in b[0])
+        print(f"  従来のタイトル行を含む結果: {same}/{len(corpus)}（差分は段組み断片の結合によるもの）")
+        for (name, _), old, new in zip(corpus[:5], old_results, new_results):
+            print(f"    {name}: 従来『{old[0]}』 → 新『{new[0]}』")
+
+    def _join_continuation(self, title: str, next_text: str) -> str:
+        """候補行の直下の同等サイズ行が続きなら結合（ハイフン改行や単語分割対策）。"""
         try:
-            y0, sz, text = cand
-            # 直下行の候補を探索（y差が小さく、サイズ差が小さい）
-            below = [t for t in lines_agg if (t[0] > y0 and abs(t[1]-sz) <= max(1.0, sz*0.1))]
-            if not below:
-                return title
-            nxt = sorted(below, key=lambda t: t[0])[0]
-            next_text = nxt[2].strip()
             # ハイフン改行や明らかな単語継続のとき結合
             if title.rstrip().endswith(('-', '‐', '‑', '–', '—')):
                 return re.sub(r"[-‐‑–—]+\s*$", "", title) + next_text
@@ -2299,32 +4976,15 @@ class AutoPDFWatcherAdvanced:
         """
         try:
             label = (ai_label or '').strip()
-            t = (text or '').lower()
-            # 日本語キーワードの単純検出（大文字小文字鈍感にするためlower）
-            # 主たる書類候補とキーワード
-            primary = [
-                ('計算書', ['計算書', '損益計算書', '貸借対照表', '決算書', '財務諸表']),
-                ('契約書', ['契約書', '覚書', '合意書']),
-                ('見積書', ['見積書']),
-                ('請求書', ['請求書', '請求金額']),
-                ('領収書', ['領収書', '受領']),
-                ('納品書', ['納品書']),
-            ]
-            # 従たる/汎用キーワード
-            secondary_words = ['資料', '添付資料', '参考資料', '別紙', '付録', '別添']
-
-            def count_any(words):
-                c = 0
-                for w in words:
-                    if w.lower() in t:
-                        c += t.count(w.lower())
-                return c
+            # 全キーワード表を1回の走査で数える（大文字小文字は区別しない）
+            matcher = self.keyword_matcher
+            hits = matcher.scan(text or '')
 
             # 二次的な語が多く、AIが『資料/その他』と判断した場合は主たる候補を再評価
             if any(sw in label for sw in ['資料', 'その他']) or label in ['', 'PDF文書']:
                 best = (label, 0)
-                for name, kws in primary:
-                    c = count_any(kws)
+                for name, _ in DocumentKeywords.PRIMARY:
+                    c = matcher.count(hits, f'primary:{name}')
                     if c > best[1]:
                         best = (name, c)
                 if best[1] >= 1:
@@ -2333,7 +4993,7 @@ class AutoPDFWatcherAdvanced:
             # AIが既に主たる名を返している場合でも、明らかな矛盾（資料多すぎ）はスキップ
             # もしくはAIが『受付のお知らせ』等の場合、財務系語が強ければ『計算書』へ
             if label in ['受付のお知らせ', '必要書類等一覧', 'PDF文書', 'その他書類']:
-                calc_score = count_any(['計算書', '損益計算書', '貸借対照表', '決算書'])
+                calc_score = matcher.count(hits, 'financial')
                 if calc_score >= 1:
                     return '計算書'
             return label
@@ -2348,22 +5008,10 @@ class AutoPDFWatcherAdvanced:
             return "PDF文書"
         dt = document_type.strip()
         try:
-            mapping = [
-                # 司法書士系の正規化
-                (r"印鑑証明", "印鑑証明書"),
-                (r"(登記事項証明|全部事項証明|現在事項証明)", "登記事項証明書"),
-                # 一般書類
-                (r"請求(書)?", "請求書"),
-                (r"見積(書)?", "見積書"),
-                (r"領収(書)?", "領収書"),
-                (r"納品(書)?", "納品書"),
-                (r"注文(書)?", "注文書"),
-                (r"契約(書)?", "契約書"),
-            ]
-            import re as _re
-            for pat, name in mapping:
-                if _re.search(pat, dt):
-                    return name
+            name = self.keyword_matcher.first_category(
+                dt, [f'normalize:{n}' for n, _ in DocumentKeywords.NORMALIZE])
+            if name:
+                return name.split(':', 1)[1]
         except Exception:
             pass
         return dt
@@ -2442,17 +5090,7 @@ class AutoPDFWatcherAdvanced:
             images = images if isinstance(images, (list, tuple)) else [images]
             img_blocks = []
             for img in images[:2]:
-                buffer = io.BytesIO()
-                img.save(buffer, format='PNG')
-                image_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                img_blocks.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/png",
-                        "data": image_data
-                    }
-                })
+                img_blocks.append(self._image_block(img))
             base_prompt = (
                 "この文書の主たるページ（1ページ目）に記載の『タイトルまたは種類名』を1つだけ返してください。\n"
                 "条件: 句読点・説明なし、名詞句のみ。\n"
@@ -2584,7 +5222,8 @@ class AutoPDFWatcherAdvanced:
                     break
                 counter += 1
             
-            # ファイルを移動またはリネーム
+            # ファイルを移動またはリネーム（出力先が監視下でも再処理しないよう先に登録）
+            self._mark_self_produced(new_path)
             if directory != os.path.dirname(original_path):
                 # 別フォルダに移動
                 import shutil
@@ -2649,72 +5288,197 @@ class AutoPDFWatcherAdvanced:
         imgs = self.pdf_to_images(pdf_path, max_pages=1)
         return imgs[0] if imgs else None
 
-    def pdf_to_images(self, pdf_path, max_pages=2):
-        """PDFの先頭max_pagesページを画像に変換（適応的解像度処理）"""
+    def _open_document(self, source):
+        """パスまたは ParsedDocument を受け取り (ParsedDocument, 呼び出し側で閉じるか) を返す"""
+        if isinstance(source, ParsedDocument):
+            return source, False
+        return ParsedDocument(source), True
+
+    def pdf_to_images(self, pdf_path, max_pages=2, lazy=False, colorspace='auto'):
+        """PDFの先頭max_pagesページを画像に変換
+        倍率はページサイズと1ページあたりの画像トークン予算から事前に決め、1回だけレンダリングする。
+        pdf_path には ParsedDocument も渡せる（その場合はレンダリング結果を共有）。
+        lazy=True なら LazyPageImage のリストを返す（ParsedDocument を閉じるまでに解決すること）。
+        colorspace: auto（白黒ページはグレー）/ rgb / gray / bilevel
+        """
+        doc, owned = None, False
         try:
-            doc = fitz.open(pdf_path)
-            if len(doc) == 0:
+            doc, owned = self._open_document(pdf_path)
+            if doc.page_count == 0:
                 return []
-            images = []
-            page_count = min(len(doc), max_pages)
-            for i in range(page_count):
-                page = doc[i]
-                # まず元サイズをチェック
-                pix_check = page.get_pixmap()
-                check_size = len(pix_check.tobytes("png"))
-                # サイズに応じて適応的に解像度調整
-                if check_size < 500000:  # 0.5MB未満 = 小さすぎる
-                    pix = page.get_pixmap(matrix=fitz.Matrix(2.0, 2.0))
-                elif check_size < 1500000:  # 1.5MB未満 = やや小さい
-                    pix = page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5))
-                else:  # 1.5MB以上 = 十分大きい
-                    pix = page.get_pixmap()
-
-                img_data = pix.tobytes("png")
-                final_size = len(img_data)
-                if final_size <= 5000000:  # 5MB以下
-                    images.append(Image.open(io.BytesIO(img_data)))
-                else:
-                    image = Image.open(io.BytesIO(img_data))
-                    images.append(self.light_compress_for_api(image))
-            doc.close()
-            return images
+            page_count = min(doc.page_count, max_pages)
+            token_budget = self._image_token_budget()
+            handles = [LazyPageImage(doc, i, self._page_scale(doc, i, token_budget), self._pixmap_to_image, colorspace)
+                       for i in range(page_count)]
+            if lazy and not owned:
+                return handles
+            return [h.get() for h in handles]
         
         except Exception as e:
             print(f"PDF変換エラー: {e}")
             return []
+        finally:
+            if owned:
+                doc.close()
     
+    def _page_scale(self, doc, index, token_budget) -> float:
+        """トークン予算に合わせたレンダリング倍率"""
+        width, height = doc.page_size(index)
+        return APIRateLimiter.image_scale_for_budget(width, height, token_budget)
+
+    def _pixmap_to_image(self, pix):
+        """ピクスマップをPIL画像にする（5MB超は軽圧縮）"""
+        img_data = pix.tobytes("png")
+        image = Image.open(io.BytesIO(img_data))
+        if len(img_data) <= 5000000:  # 5MB以下
+            return image
+        return self.light_compress_for_api(image)
+
+    def _image_token_budget(self) -> int:
+        """1ページあたりの画像トークン予算（APIの換算: 幅×高さ/750）"""
+        try:
+            return max(200, int(self.config.get('image_token_budget_per_page', 1600)))
+        except Exception:
+            return 1600
+
+    @staticmethod
+    def _flatten_for_jpeg(image):
+        """JPEG保存できるモード（RGB/L）にする。透過は白背景で合成"""
+        if image.mode == 'RGBA':
+            rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+            rgb_image.paste(image, mask=image.split()[-1])
+            return rgb_image
+        if image.mode not in ('RGB', 'L'):
+            return image.convert('RGB')
+        return image
+
+    @staticmethod
+    def _jpeg_sample_mosaic(image, tile: int = 64, stride: int = 8):
+        """サイズ予測用に、画像全体から1/stride のタイルを散らして集めた縮小版を作る。
+        縮小（リサンプリング）と違い細部の密度が保たれるため、品質ごとのサイズ比がほぼ一定になる。
+        小さな画像では None（全体をそのまま使う）。
+        """
+        width, height = image.size
+        cols, rows = width // tile, height // tile
+        if cols * rows < stride * 4:
+            return None
+        positions = [(c * tile, r * tile) for r in range(rows) for c in range(cols) if (c + r * 3) % stride == 0]
+        per_row = max(1, int(len(positions) ** 0.5))
+        mosaic = Image.new(image.mode, (per_row * tile, ((len(positions) + per_row - 1) // per_row) * tile),
+                           255 if image.mode == 'L' else (255, 255, 255))
+        for i, (x, y) in enumerate(positions):
+            mosaic.paste(image.crop((x, y, x + tile, y + tile)), ((i % per_row) * tile, (i // per_row) * tile))
+        return mosaic
+
+    @staticmethod
+    def encode_jpeg_to_target(image, max_bytes: int, q_max: int = 95, q_min: int = 30,
+                              max_encodes: int = 3) -> tuple[bytes, int, int]:
+        """max_bytes 以下に収まる、なるべく高い品質のJPEGを少ないエンコード回数で作る。
+        1) q_max で全体をエンコードし、収まればそのまま
+        2) 小さなサンプル（タイルのモザイク）上で品質を二分探索し、全体との実測サイズ比から目標に合う品質を予測
+        3) 予測した品質で全体をエンコード。外れたら比を補正して再探索し、最後は q_min
+        全体のエンコードは最大 max_encodes 回。戻り値は (データ, 品質, 全体エンコード回数)。
+        最後まで収まらない場合は q_min のデータを返す（サイズ確認は呼び出し側）。
+        """
+        def encode(img, quality):
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=quality, optimize=True)
+            return buffer.getvalue()
+
+        image = AutoPDFWatcherAdvanced._flatten_for_jpeg(image)
+        data = encode(image, q_max)
+        encodes = 1
+        if len(data) <= max_bytes or q_max <= q_min:
+            return data, q_max, encodes
+
+        sample = AutoPDFWatcherAdvanced._jpeg_sample_mosaic(image) or image
+        sample_sizes = {}
+
+        def sample_size(quality):
+            if quality not in sample_sizes:
+                sample_sizes[quality] = len(encode(sample, quality))
+            return sample_sizes[quality]
+
+        ratio = len(data) / max(1, sample_size(q_max))
+        target = max_bytes * 0.98
+        q_hi = q_max
+        quality = q_min
+        while encodes < max_encodes:
+            quality = q_min
+            if encodes < max_encodes - 1:
+                # 予測サイズが目標以下になる最大の品質を二分探索
+                lo, hi = q_min, q_hi - 1
+                while lo <= hi:
+                    mid = (lo + hi) // 2
+                    if sample_size(mid) * ratio <= target:
+                        quality, lo = mid, mid + 1
+                    else:
+                        hi = mid - 1
+            data = encode(image, quality)
+            encodes += 1
+            if len(data) <= max_bytes or quality <= q_min:
+                return data, quality, encodes
+            # 予測が外れた分だけ比を補正
+            ratio = len(data) / max(1, sample_size(quality))
+            q_hi = quality
+        return data, quality, encodes
+
+    @staticmethod
+    def run_jpeg_benchmark(rounds: int = 3):
+        """--bench-jpeg: 従来の線形な品質ループと encode_jpeg_to_target を比較して表示する。
+        A4・200dpi相当の擬似スキャン画像で、目標サイズ（各品質でのサイズ）ごとに
+        全体エンコード回数と所要時間を測る。
+        """
+        from PIL import ImageDraw as _Draw
+        rng = random.Random(1234)
+        width, height = 1654, 2339
+        page = Image.new('L', (width, height), 250)
+        draw = _Draw.Draw(page)
+        for _ in range(2500):
+            x, y = rng.randrange(80, width - 120), rng.randrange(80, height - 60)
+            draw.rectangle((x, y, x + rng.randrange(8, 40), y + rng.randrange(10, 26)), fill=rng.randrange(0, 90))
+        noise = Image.effect_noise((width, height), 18)
+        page = Image.blend(page, noise, 0.12)
+        image = Image.merge('RGB', (page, page.point(lambda v: min(255, v + 4)), page))
+
+        def size_at(quality):
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True)
+            return len(buffer.getvalue())
+
+        def legacy(max_bytes):
+            # 変更前: 95→80 を5刻み、次に 85→30 を10刻みで全体を再エンコード
+            encodes = 0
+            for quality in list(range(95, 79, -5)) + list(range(85, 29, -10)):
+                encodes += 1
+                if size_at(quality) <= max_bytes:
+                    return quality, encodes
+            return 30, encodes
+
+        print(f"JPEG品質探索ベンチマーク: {width}x{height} 擬似スキャン, {rounds}回平均")
+        print(f"{'目標':>10} | {'従来 品質/回数/ms':>20} | {'新方式 品質/回数/ms':>20}")
+        for ref_quality in (90, 75, 60, 45, 35):
+            target = size_at(ref_quality)
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                old_q, old_n = legacy(target)
+            old_ms = (time.perf_counter() - t0) * 1000 / rounds
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                data, new_q, new_n = AutoPDFWatcherAdvanced.encode_jpeg_to_target(image, target, 95, 30)
+            new_ms = (time.perf_counter() - t0) * 1000 / rounds
+            print(f"{target:>10} | {old_q:>5} / {old_n:>2} / {old_ms:>7.1f} | "
+                  f"{new_q:>5} / {new_n:>2} / {new_ms:>7.1f}  ({len(data)} bytes)")
+
     def light_compress_for_api(self, image):
-        """5MB超過時の軽い圧縮（品質重視）"""
+        """5MB超過時の軽い圧縮（品質重視・品質95〜80の範囲で目標サイズに合わせる）"""
         try:
             max_size = 4900000  # 4.9MB（安全マージン）
-            
-            # RGBAの場合はRGBに変換
-            if image.mode == 'RGBA':
-                rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                rgb_image.paste(image, mask=image.split()[-1])
-                image = rgb_image
-                print("RGBA→RGB変換完了")
-            
-            # 高品質のJPEG圧縮から開始
-            quality = 95
-            current_size = max_size + 1
-            
-            while current_size > max_size and quality >= 80:
-                buffer = io.BytesIO()
-                image.save(buffer, format='JPEG', quality=quality, optimize=True)
-                current_size = len(buffer.getvalue())
-                
-                print(f"軽圧縮テスト: {current_size} bytes (品質: {quality})")
-                
-                if current_size <= max_size:
-                    buffer.seek(0)
-                    compressed_image = Image.open(buffer)
-                    print(f"✅ 軽圧縮完了: {current_size} bytes (品質: {quality})")
-                    return compressed_image
-                
-                quality -= 5  # 細かく調整
-            
+            data, quality, encodes = self.encode_jpeg_to_target(image, max_size, q_max=95, q_min=80)
+            if len(data) <= max_size:
+                print(f"✅ 軽圧縮完了: {len(data)} bytes (品質: {quality}, エンコード{encodes}回)")
+                return Image.open(io.BytesIO(data))
+
             # それでも大きい場合は従来の強圧縮
             print("強圧縮に切り替え")
             return self.compress_image_for_api(image)
@@ -2741,56 +5505,28 @@ class AutoPDFWatcherAdvanced:
                 image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
                 print(f"サイズ縮小: {new_width}x{new_height}")
             
-            # RGBAの場合はRGBに変換
-            if image.mode == 'RGBA':
-                rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-                rgb_image.paste(image, mask=image.split()[-1])
-                image = rgb_image
-                print("RGBA→RGB変換完了")
-            
-            # JPEG形式で段階的に品質を下げて圧縮
-            quality = 85
-            current_size = max_size + 1
+            # 品質85〜30の範囲で目標サイズに合わせる
+            data, quality, encodes = self.encode_jpeg_to_target(image, max_size, q_max=85, q_min=30)
+            if len(data) <= max_size:
+                print(f"✅ 圧縮成功: {len(data)} bytes (品質: {quality}, エンコード{encodes}回)")
+                return Image.open(io.BytesIO(data))
             
-            while current_size > max_size and quality >= 30:
+            # それでもサイズが大きい場合は、面積比から必要な縮小率を求めて縮小（下限400px）
+            image = self._flatten_for_jpeg(image)
+            width, height = image.size
+            current_size = len(data)
+            while current_size > max_size and (width > 400 or height > 400):
+                ratio = max(0.3, min(0.9, (max_size / current_size) ** 0.5 * 0.95))
+                width, height = max(1, int(width * ratio)), max(1, int(height * ratio))
+                resized = image.resize((width, height), Image.Resampling.LANCZOS)
                 buffer = io.BytesIO()
-                image.save(buffer, format='JPEG', quality=quality, optimize=True)
-                current_size = len(buffer.getvalue())
-                
-                print(f"圧縮テスト: {current_size} bytes (品質: {quality})")
-                
-                if current_size <= max_size:
-                    # 圧縮成功
-                    buffer.seek(0)
-                    compressed_image = Image.open(buffer)
-                    print(f"✅ 圧縮成功: {current_size} bytes (品質: {quality})")
-                    return compressed_image
-                
-                # 品質を下げて再試行
-                quality -= 10
-            
-            # それでもサイズが大きい場合は、さらに画像サイズを縮小
-            if current_size > max_size:
-                width, height = image.size
-                while current_size > max_size and (width > 400 or height > 400):
-                    ratio = 0.8  # 20%縮小
-                    new_width = int(width * ratio)
-                    new_height = int(height * ratio)
-                    image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    width, height = new_width, new_height
-                    
-                    buffer = io.BytesIO()
-                    image.save(buffer, format='JPEG', quality=50, optimize=True)
-                    current_size = len(buffer.getvalue())
-                    
-                    print(f"さらに縮小: {current_size} bytes (サイズ: {width}x{height})")
-                
-                buffer.seek(0)
-                final_image = Image.open(buffer)
-                print(f"✅ 最終圧縮: {current_size} bytes")
-                return final_image
+                resized.save(buffer, format='JPEG', quality=50, optimize=True)
+                data = buffer.getvalue()
+                current_size = len(data)
+                print(f"さらに縮小: {current_size} bytes (サイズ: {width}x{height})")
             
-            return image
+            print(f"✅ 最終圧縮: {current_size} bytes")
+            return Image.open(io.BytesIO(data))
             
         except Exception as e:
             print(f"画像圧縮エラー: {e}")
@@ -2835,30 +5571,46 @@ class AutoPDFWatcherAdvanced:
 
     def _anthropic_call_with_retry(self, content_blocks, *, max_tokens=100, temperature=0, timeout=30.0,
                                    models=None, retries=3):
-        """Anthropic API呼び出し（モデルフォールバック + 529混雑時の指数バックオフ）"""
+        """Anthropic API呼び出し（共有レート制限 + モデルフォールバック + 529/429時の指数バックオフ）"""
         if not self.claude_client:
             raise RuntimeError('Claude API未設定')
         primary = self.get_model()
         fb = 'claude-3-5-sonnet-20241022'
         try_models = models or ([primary] + ([fb] if fb != primary else []))
+        est_input = self.rate_limiter.estimate_content_tokens(content_blocks)
         last_err = None
         for m in try_models:
             delay = 1.5
             for attempt in range(retries):
+                waited = self.rate_limiter.acquire(est_input, max_tokens)
+                if waited >= 1.0:
+                    self.log_message(f"⏳ APIレート制限のため {waited:.1f}s 待機しました")
                 try:
-                    return self.claude_client.messages.create(
+                    message = self.claude_client.messages.create(
                         model=m,
                         max_tokens=max_tokens,
                         temperature=temperature,
                         messages=[{"role": "user", "content": content_blocks}],
                         timeout=timeout
                     )
+                    usage = getattr(message, 'usage', None)
+                    self.rate_limiter.settle(
+                        est_input, max_tokens,
+                        getattr(usage, 'input_tokens', None), getattr(usage, 'output_tokens', None)
+                    )
+                    return message
                 except Exception as e:
                     last_err = e
+                    # 出力は発生していないので確保分を返却
+                    self.rate_limiter.settle(est_input, max_tokens, None, 0)
                     es = str(e)
                     overloaded = ('529' in es) or ('overload' in es.lower())
-                    if overloaded and attempt < retries - 1:
+                    rate_limited = ('429' in es) or ('rate_limit' in es.lower())
+                    if (overloaded or rate_limited) and attempt < retries - 1:
                         wait = delay * (1 + 0.25 * random.random())
+                        if rate_limited:
+                            # 上限超過は全呼び出し共通の問題なので、待機も共有する
+                            self.rate_limiter.pause(wait)
                         self.log_message(f"⏳ モデル混雑のため再試行({attempt+1}/{retries-1}) {wait:.1f}s 待機: {m}")
                         time.sleep(wait)
                         delay *= 2
@@ -2897,20 +5649,16 @@ class AutoPDFWatcherAdvanced:
             return "PDF文書"
 
     def extract_text_from_pdf(self, pdf_path, max_pages=2, max_chars=4000):
+        doc, owned = None, False
         try:
-            doc = fitz.open(pdf_path)
-            text_parts = []
-            for i in range(min(len(doc), max_pages)):
-                page = doc[i]
-                text_parts.append(page.get_text("text"))
-                if sum(len(t) for t in text_parts) >= max_chars:
-                    break
-            doc.close()
-            text = "\n".join(text_parts).strip()
-            return text[:max_chars]
+            doc, owned = self._open_document(pdf_path)
+            return doc.text(max_pages=max_pages, max_chars=max_chars)
         except Exception as e:
             print(f"PDFテキスト抽出エラー: {e}")
             return ""
+        finally:
+            if owned:
+                doc.close()
 
     def classify_with_vision(self, image, prompt_override=None, preset_key=None):
         """Claude Vision APIで文書分類（先頭2ページ対応・簡潔プロンプト）"""
@@ -2920,17 +5668,7 @@ class AutoPDFWatcherAdvanced:
 
             img_blocks = []
             for img in images[:2]:
-                buffer = io.BytesIO()
-                img.save(buffer, format='PNG')
-                image_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                img_blocks.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/png",
-                        "data": image_data
-                    }
-                })
+                img_blocks.append(self._image_block(img))
 
             label_list = self.build_label_set(preset_key)
             labels = "、".join(label_list)
@@ -2963,12 +5701,36 @@ class AutoPDFWatcherAdvanced:
             self.log_message(f"❌ 分類API エラー: {str(e)}")
             return "PDF文書"
     
+    def extract_names_locally(self, pdoc, filename) -> dict | None:
+        """1ページ目のテキスト層から宛名を抽出し、確信度がしきい値以上なら返す（名前抽出APIを省略）"""
+        if not self.config.get('local_addressee_enabled', True):
+            return None
+        try:
+            threshold = float(self.config.get('local_addressee_threshold', 0.75))
+        except Exception:
+            threshold = 0.75
+        try:
+            if pdoc.page_count == 0 or pdoc.page(0).rotation:
+                return None
+            width, height = pdoc.page_size(0)
+            info, confidence, evidence = AddresseeExtractor.extract(pdoc.page_lines(0), width, height)
+        except Exception as e:
+            print(f"ローカル宛名抽出エラー: {e}")
+            return None
+        if not info:
+            return None
+        shown = info['company_name'] or f"{info['surname'] or ''}{info['given_name'] or ''}"
+        if confidence < threshold:
+            self.log_message(f"🔍 宛名候補（確信度 {confidence:.2f}・画像で再確認）: {filename} {shown}")
+            return None
+        self.log_message(f"⚡ ローカル宛名抽出: {filename} → {shown}（確信度 {confidence:.2f}・API省略）")
+        print(f"宛名の根拠行: {evidence}")
+        return info
+
     def extract_names_and_companies(self, image):
         """宛名（受取人）を抽出。説明を返された場合でも粘り強く再試行して3行形式を得る。"""
         try:
-            buffer = io.BytesIO()
-            image.save(buffer, format='PNG')
-            image_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            image_block = self._image_block(image)
 
             base_prompt = (
                 "この日本の文書から『宛名（受取人）』のみを抽出してください。差出人（発行者）は除外してください。\n\n"
@@ -2984,7 +5746,7 @@ class AutoPDFWatcherAdvanced:
                 return self._anthropic_call_with_retry(
                     [
                         {"type": "text", "text": prompt_text},
-                        {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": image_data}},
+                        image_block,
                     ],
                     max_tokens=120, temperature=0, timeout=30.0
                 )
@@ -3041,18 +5803,11 @@ class AutoPDFWatcherAdvanced:
     def extract_property_info(self, image, document_type):
         """登記関連書類から不動産情報を抽出（最適化版）"""
         # 登記関連書類でない場合はスキップ
-        registry_keywords = [
-            '登記事項証明書', '登記情報', '登記簿', 
-            '全部事項証明書', '現在事項証明書', '建物事項証明書',
-            '土地登記', '建物登記', '不動産登記'
-        ]
-        if not any(keyword in document_type for keyword in registry_keywords):
+        if not self.keyword_matcher.has(document_type or '', 'registry'):
             return None
             
         try:
-            buffer = io.BytesIO()
-            image.save(buffer, format='PNG')
-            image_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            image_block = self._image_block(image)
             
             prompt = """この登記簿から不動産情報を抽出してください。
 
@@ -3076,34 +5831,13 @@ class AutoPDFWatcherAdvanced:
 所在：なし
 地番等：パークマンション801号"""
 
-            def _call3(model):
-                return self.claude_client.messages.create(
-                    model=model,
-                    max_tokens=150,
-                    temperature=0,
-                    messages=[{
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/png",
-                                    "data": image_data
-                                }
-                            }
-                        ]
-                    }],
-                    timeout=30.0
-                )
-            model_primary = self.get_model()
-            try:
-                message = _call3(model_primary)
-            except Exception as e:
-                fb = 'claude-3-5-sonnet-20241022'
-                self.log_message(f"⚠️ モデル '{model_primary}' 失敗。フォールバック {fb} を試行: {e}")
-                message = _call3(fb)
+            message = self._anthropic_call_with_retry(
+                [
+                    {"type": "text", "text": prompt},
+                    image_block
+                ],
+                max_tokens=150, temperature=0, timeout=30.0
+            )
             
             response = message.content[0].text.strip()
             print(f"不動産情報API生レスポンス: {response}")
@@ -3208,6 +5942,23 @@ class AutoPDFWatcherAdvanced:
                     self.stop_watching()
             except Exception:
                 pass
+            try:
+                if self.observer is not None:
+                    self.observer.stop()
+                    self.observer.join(timeout=2)
+            except Exception:
+                pass
+            try:
+                self.polling_watcher.stop()
+                self.stability_monitor.stop()
+                self.job_queue.stop()
+                if self.render_farm:
+                    self.render_farm.shutdown()
+                self._flush_manifests()
+                if self.journal:
+                    self.journal.close()
+            except Exception:
+                pass
             try:
                 if self.tray_icon:
                     try:
@@ -3347,6 +6098,17 @@ class AutoPDFWatcherAdvanced:
         self.window.mainloop()
 
 if __name__ == "__main__":
+    # exe化した場合、レンダリング用の子プロセスがここでアプリを起動しないようにする
+    multiprocessing.freeze_support()
+    # ベンチマーク（GUIを起動せずに結果を表示して終了）
+    if '--bench-jpeg' in sys.argv:
+        AutoPDFWatcherAdvanced.run_jpeg_benchmark()
+        sys.exit(0)
+    if '--bench-layout' in sys.argv:
+        i = sys.argv.index('--bench-layout')
+        bench_dir = sys.argv[i + 1] if len(sys.argv) > i + 1 and not sys.argv[i + 1].startswith('--') else None
+        AutoPDFWatcherAdvanced.run_layout_benchmark(bench_dir)
+        sys.exit(0)
     # シングルトン確保（多層ロック：ファイルロック → TCP → Windows Mutex）
     running = False
     mutex_handle = None
@@ -0,0 +1,52 @@
+"""FolderSettingsIndex（パス要素のトライ木による最長一致検索）のテスト。
+本体は Windows 用の依存を読み込むため、揃っていない環境ではスキップする。
+"""
+import os
+import sys
+
+import pytest
+
+for _mod in ('winreg', 'fitz', 'watchdog', 'pystray', 'PIL', 'anthropic'):
+    pytest.importorskip(_mod)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import auto_pdf_watcher_advanced_distribution as app_module  # noqa: E402
+
+
+def _index(tmp_path, *relpaths):
+    folders = [{'path': str(tmp_path.joinpath(*p.split('/'))), 'name': p} for p in relpaths]
+    return app_module.FolderSettingsIndex(folders)
+
+
+def _lookup_name(index, tmp_path, relpath):
+    found = index.lookup(str(tmp_path.joinpath(*relpath.split('/'))))
+    return found['name'] if found else None
+
+
+def test_returns_deepest_registered_folder(tmp_path):
+    index = _index(tmp_path, 'data', 'data/a', 'data/a/b')
+    assert _lookup_name(index, tmp_path, 'data/a/b/c/x.pdf') == 'data/a/b'
+    assert _lookup_name(index, tmp_path, 'data/a/x.pdf') == 'data/a'
+    assert _lookup_name(index, tmp_path, 'data/x.pdf') == 'data'
+    assert _lookup_name(index, tmp_path, 'other/x.pdf') is None
+
+
+def test_matches_whole_path_elements_only(tmp_path):
+    index = _index(tmp_path, 'data', 'data/a')
+    # 「data/ab」は文字列としては「data/a」で始まるが、別のフォルダ
+    assert _lookup_name(index, tmp_path, 'data/ab/x.pdf') == 'data'
+
+
+def test_remove_falls_back_to_parent(tmp_path):
+    index = _index(tmp_path, 'data', 'data/a', 'data/a/b')
+    index.remove(str(tmp_path / 'data' / 'a'))
+    assert _lookup_name(index, tmp_path, 'data/a/x.pdf') == 'data'
+    assert _lookup_name(index, tmp_path, 'data/a/b/x.pdf') == 'data/a/b'
+    index.remove(str(tmp_path / 'data' / 'a' / 'b'))
+    assert _lookup_name(index, tmp_path, 'data/a/b/x.pdf') == 'data'
+
+
+def test_add_replaces_settings_for_same_path(tmp_path):
+    index = _index(tmp_path, 'data')
+    index.add({'path': str(tmp_path / 'data'), 'name': 'updated'})
+    assert _lookup_name(index, tmp_path, 'data/x.pdf') == 'updated'
@@ -0,0 +1,90 @@
+"""PDFJobQueue のレーン（対話レーン・重み付きラウンドロビン・低優先度）の順序と公平性のテスト。
+ワーカーは起動せず、取り出し順だけを確かめる。
+本体は Windows 用の依存を読み込むため、揃っていない環境ではスキップする。
+"""
+import os
+import sys
+
+import pytest
+
+for _mod in ('winreg', 'fitz', 'watchdog', 'pystray', 'PIL', 'anthropic'):
+    pytest.importorskip(_mod)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import auto_pdf_watcher_advanced_distribution as app_module  # noqa: E402
+
+
+def _queue(weights=None, caps=None):
+    weights = weights or {}
+    caps = caps or {}
+    return app_module.PDFJobQueue(lambda path: None, workers=1, capacity=1000,
+                                  policy=lambda folder: (weights.get(folder, 1), caps.get(folder, 0)))
+
+
+def _take(queue, n):
+    return [queue._next_job() for _ in range(n)]
+
+
+def test_single_file_goes_ahead_of_bulk_lane():
+    q = _queue()
+    for i in range(5):
+        q.submit(f'A/{i}.pdf', folder='A')
+    q.submit('B/0.pdf', folder='B')
+    order = [path for path, _ in _take(q, 6)]
+    # 各フォルダの最初の1件は対話レーン（到着順）、その後に大量投入分
+    assert order[:2] == ['A/0.pdf', 'B/0.pdf']
+    assert order[2:] == ['A/1.pdf', 'A/2.pdf', 'A/3.pdf', 'A/4.pdf']
+
+
+def test_weighted_round_robin_shares_by_weight_and_keeps_fifo():
+    q = _queue(weights={'A': 2, 'B': 1})
+    for folder in ('A', 'B'):
+        for i in range(13):
+            q.submit(f'{folder}/{i}.pdf', folder=folder)
+    _take(q, 2)  # 対話レーンの A/0, B/0
+    picked = _take(q, 18)
+    folders = [folder for _, folder in picked]
+    assert folders.count('A') == 12 and folders.count('B') == 6
+    # 重み2:1 が偏らずに交互に配られる（同じフォルダが3回以上続かない）
+    assert 'AAA' not in ''.join(folders)
+    for folder in ('A', 'B'):
+        paths = [p for p, f in picked if f == folder]
+        assert paths == sorted(paths, key=lambda p: int(p.split('/')[1][:-4]))
+
+
+def test_equal_weights_alternate():
+    q = _queue()
+    for folder in ('A', 'B', 'C'):
+        for i in range(4):
+            q.submit(f'{folder}/{i}.pdf', folder=folder)
+    _take(q, 3)
+    folders = ''.join(folder for _, folder in _take(q, 9))
+    assert sorted(folders[:3]) == ['A', 'B', 'C']
+    assert sorted(folders[3:6]) == ['A', 'B', 'C']
+
+
+def test_low_priority_runs_only_when_nothing_else_is_waiting():
+    q = _queue()
+    q.submit('A/low.pdf', folder='A', priority='low')
+    for i in range(3):
+        q.submit(f'B/{i}.pdf', folder='B')
+    order = [path for path, _ in _take(q, 4)]
+    assert order[-1] == 'A/low.pdf'
+
+
+def test_duplicate_submit_is_ignored():
+    q = _queue()
+    assert q.submit('A/0.pdf', folder='A')
+    assert q.submit('A/0.pdf', folder='A')
+    assert q.depth() == (1, 0)
+
+
+def test_folder_cap_defers_to_other_lanes():
+    q = _queue(caps={'A': 1})
+    for i in range(3):
+        q.submit(f'A/{i}.pdf', folder='A')
+    q.submit('B/0.pdf', folder='B')
+    first = q._next_job()
+    assert first == ('A/0.pdf', 'A')
+    # A は上限1件に達しているので、次は B
+    assert q._next_job() == ('B/0.pdf', 'B')
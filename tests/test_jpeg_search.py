@@ -0,0 +1,67 @@
+"""encode_jpeg_to_target（予測つき品質探索）のテスト。
+本体は Windows 用の依存を読み込むため、揃っていない環境ではスキップする。
+"""
+import os
+import sys
+
+import pytest
+
+for _mod in ('winreg', 'fitz', 'watchdog', 'pystray', 'PIL', 'anthropic'):
+    pytest.importorskip(_mod)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import auto_pdf_watcher_advanced_distribution as app_module  # noqa: E402
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+
+def _scan_like_image(seed=7, size=(1200, 1600)):
+    """文字行とノイズのある擬似スキャン画像"""
+    rng = random.Random(seed)
+    img = Image.new('RGB', size, (250, 250, 245))
+    draw = ImageDraw.Draw(img)
+    for y in range(80, size[1] - 80, 28):
+        x = 60
+        while x < size[0] - 120:
+            w = rng.randint(20, 90)
+            draw.rectangle([x, y, x + w, y + 14], fill=(rng.randint(0, 60),) * 3)
+            x += w + rng.randint(8, 20)
+    noise = Image.effect_noise(size, 18).convert('RGB')
+    return Image.blend(img, noise, 0.12)
+
+
+def _encoded_size(image, quality):
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=quality, optimize=True)
+    return len(buf.getvalue())
+
+
+def test_returns_q_max_when_it_already_fits():
+    image = _scan_like_image()
+    limit = _encoded_size(image, 95) + 1
+    data, quality, encodes = app_module.AutoPDFWatcherAdvanced.encode_jpeg_to_target(image, limit)
+    assert quality == 95
+    assert encodes == 1
+    assert len(data) <= limit
+
+
+@pytest.mark.parametrize('target_quality', [85, 70, 55, 40])
+def test_meets_size_target_within_encode_budget(target_quality):
+    image = _scan_like_image()
+    limit = _encoded_size(image, target_quality)
+    data, quality, encodes = app_module.AutoPDFWatcherAdvanced.encode_jpeg_to_target(image, limit, max_encodes=3)
+    assert len(data) <= limit
+    assert 30 <= quality <= 95
+    assert encodes <= 3
+    assert data[:2] == b'\xff\xd8'
+    # 目標に届く品質のうち、大きく下回るものを選んでいない
+    assert quality >= target_quality - 10
+
+
+def test_falls_back_to_q_min_when_target_is_unreachable():
+    image = _scan_like_image()
+    data, quality, encodes = app_module.AutoPDFWatcherAdvanced.encode_jpeg_to_target(image, 1000, q_min=30)
+    assert quality == 30
+    assert encodes <= 3
@@ -0,0 +1,55 @@
+"""KeywordMatcher / DocumentKeywords のテスト（キーワードごとの単純な検索と同じ結果になること）。
+本体は Windows 用の依存を読み込むため、揃っていない環境ではスキップする。
+"""
+import os
+import sys
+
+import pytest
+
+for _mod in ('winreg', 'fitz', 'watchdog', 'pystray', 'PIL', 'anthropic'):
+    pytest.importorskip(_mod)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import auto_pdf_watcher_advanced_distribution as app_module  # noqa: E402
+import random
+
+
+def _random_texts(matcher, count=500, seed=1):
+    """キーワードの字を多めに混ぜた（重なり・接頭辞の関係が起きやすい）テキスト"""
+    rng = random.Random(seed)
+    alphabet = sorted({ch for k in matcher.keywords for ch in k}) + list('のです。\n 　ABCabc')
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 300))) for _ in range(count)]
+
+
+def test_counts_match_per_keyword_count():
+    matcher = app_module.DocumentKeywords.matcher()
+    for text in _random_texts(matcher):
+        lowered = text.lower()
+        counts = matcher.counts(text)
+        for name, keywords in matcher.categories.items():
+            assert counts[name] == sum(lowered.count(k) for k in keywords), (name, text)
+
+
+def test_has_matches_per_keyword_in():
+    matcher = app_module.DocumentKeywords.matcher()
+    for text in _random_texts(matcher, seed=2):
+        lowered = text.lower()
+        for name, keywords in matcher.categories.items():
+            assert matcher.has(text, name) == any(k in lowered for k in keywords), (name, text)
+
+
+def test_overlapping_keywords_are_all_counted():
+    matcher = app_module.KeywordMatcher({'calc': ['計算書', '損益計算書'], 'other': ['益計']})
+    hits = matcher.scan('損益計算書と計算書')
+    assert hits['損益計算書'] == (1, 0)
+    assert hits['計算書'] == (2, 2)
+    assert hits['益計'] == (1, 1)
+    assert matcher.count(hits, 'calc') == 3
+
+
+def test_first_category_follows_given_order():
+    names = [f'normalize:{n}' for n, _ in app_module.DocumentKeywords.NORMALIZE]
+    matcher = app_module.DocumentKeywords.matcher()
+    assert matcher.first_category('御見積書（控）', names) == 'normalize:見積書'
+    assert matcher.first_category('印鑑証明書の請求', names) == 'normalize:印鑑証明書'
+    assert matcher.first_category('資料', names) is None
@@ -0,0 +1,144 @@
+"""テキスト層のヒューリスティック（品質判定・注目領域）のテスト。
+本体は Windows 用の依存（winreg, pystray など）を読み込むため、揃っていない環境ではスキップする。
+"""
+import os
+import sys
+
+import pytest
+
+for _mod in ('winreg', 'fitz', 'watchdog', 'pystray', 'PIL', 'anthropic'):
+    pytest.importorskip(_mod)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fitz  # noqa: E402
+import auto_pdf_watcher_advanced_distribution as app_module  # noqa: E402
+
+
+def _make_pdf(tmp_path, pages, name='doc.pdf'):
+    """pages: ページごとの [(y, テキスト, フォントサイズ)]"""
+    doc = fitz.open()
+    for lines in pages:
+        page = doc.new_page(width=595, height=842)
+        for y, text, size in lines:
+            page.insert_text((60, y), text, fontname='japan', fontsize=size)
+    path = tmp_path / name
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def _bare_app():
+    app = app_module.AutoPDFWatcherAdvanced.__new__(app_module.AutoPDFWatcherAdvanced)
+    app.config = {}
+    app.log_message = lambda message: None
+    return app
+
+
+def test_short_text_is_not_scored():
+    score, detail = app_module.TextQualityScorer.score('見積書')
+    assert score is None
+    assert detail['chars'] == 3
+
+
+def test_short_clean_cover_page_keeps_first_page_paths(tmp_path):
+    body = [(100 + i * 20, '下記の通りお見積り申し上げます。ご確認のほどよろしくお願いいたします。', 11)
+            for i in range(10)]
+    path = _make_pdf(tmp_path, [[(120, '見積書', 28)], body])
+    with app_module.ParsedDocument(path) as pdoc:
+        text_ok, first_page_ok = _bare_app().assess_text_quality(pdoc, 'doc.pdf')
+    assert first_page_ok is True
+    assert text_ok is True
+
+
+def test_registry_region_matches_spaced_headings(tmp_path):
+    lines = [(80, '全部事項証明書（建物）', 16),
+             (200, '表　題　部　（主である建物の表示）', 11),
+             (230, '所　在　福岡市中央区清川一丁目', 11),
+             (260, '家屋番号　11番16', 11),
+             (500, '権　利　部　（甲区）', 11),
+             (530, '所有権保存', 11)]
+    path = _make_pdf(tmp_path, [lines])
+    with app_module.ParsedDocument(path) as pdoc:
+        rect = pdoc.region_rect(0, 'registry', 0.55)
+    assert rect is not None
+    x0, y0, x1, y1 = rect
+    # 表題部の見出しから権利部の見出しの手前までに絞られる（全体やフォールバックではない）
+    assert 150 < y0 < 200
+    assert 480 < y1 < 530
+
+
+def _line(y, text, size=12.0, x0=50.0, x1=350.0):
+    """AddresseeExtractor 用の行 (y0, y1, size, text, x0, x1, flags)"""
+    return (y, y + size, size, text, x0, x1, 0)
+
+
+def _addressee(*texts):
+    lines = [_line(110 + i * 20, t) for i, t in enumerate(texts)]
+    return app_module.AddresseeExtractor.extract(lines, 595, 842)
+
+
+@pytest.mark.parametrize('text', [
+    'いつも山田様には大変お世話になっております。',
+    '先日は田中様より資料をいただきました。',
+    '平素より山田様',
+    'いつも 山田 太郎 様',
+    'いつもABC株式会社様',
+    '宮殿の見学について',
+])
+def test_addressee_ignores_body_text_mentions(text):
+    info, confidence, _ = _addressee(text)
+    assert info is None
+    assert confidence == 0.0
+
+
+def test_addressee_single_token_name_stays_below_threshold():
+    info, confidence, _ = _addressee('山田太郎 様')
+    assert info == {'surname': '山田太郎', 'given_name': None, 'company_name': None}
+    assert confidence < 0.75
+
+
+def test_addressee_split_name_and_company():
+    info, confidence, _ = _addressee('山田 太郎 様')
+    assert info == {'surname': '山田', 'given_name': '太郎', 'company_name': None}
+    assert confidence >= 0.75
+    info, confidence, _ = _addressee('ABC株式会社 営業部 佐藤 花子 様')
+    assert info == {'surname': '佐藤', 'given_name': '花子', 'company_name': 'ABC株式会社'}
+    assert confidence >= 0.75
+    info, confidence, _ = _addressee('株式会社あおぞら商事 御中')
+    assert info['company_name'] == '株式会社あおぞら商事'
+    assert confidence >= 0.75
+
+
+def test_addressee_body_mention_does_not_compete_with_heading():
+    info, confidence, _ = _addressee('山田 太郎 様', 'いつも田中様にはお世話になっております。')
+    assert info['surname'] == '山田'
+    assert confidence >= 0.75
+
+
+@pytest.mark.parametrize('text', [
+    # 地番・家屋番号など登記と共通の語はあっても、登記事項証明書ではない書類
+    '固定資産評価証明書\n令和6年度\n所在 福岡市中央区清川一丁目 地番 11番16 地目 宅地 地積 120.00\n'
+    '家屋番号 11番16の1 種類 居宅 構造 木造 評価額 12,345,000円' + ' 以下余白' * 30,
+    '名寄帳兼課税台帳\n所有者 山田太郎\n所在 地番 家屋番号 課税標準額 固定資産税 都市計画税'
+    + ' 地番 12番' * 5 + ' 家屋番号 3番' * 3,
+])
+def test_local_classifier_rejects_registry_near_misses(text):
+    label, confidence, _ = app_module.LocalDocumentClassifier.classify(text, None)
+    assert label != '登記事項証明書'
+    assert confidence < 0.75
+
+
+def test_local_classifier_accepts_clear_headings():
+    registry = ('全部事項証明書（建物）\n表題部（主である建物の表示）所在 福岡市 家屋番号 11番16\n'
+                '権利部（甲区）所有権保存' + '　' * 200)
+    label, confidence, _ = app_module.LocalDocumentClassifier.classify(registry, None)
+    assert label == '登記事項証明書' and confidence >= 0.75
+    invoice = '請求書\n下記の通りご請求申し上げます。ご請求金額 110,000円 お支払期限 振込先' + '　' * 200
+    label, confidence, _ = app_module.LocalDocumentClassifier.classify(invoice, ['請求書', '見積書'])
+    assert label == '請求書' and confidence >= 0.75
+
+
+def test_local_classifier_single_weak_label_is_not_confident():
+    label, confidence, _ = app_module.LocalDocumentClassifier.classify('ご査収ください。' * 10, None)
+    assert label is None
+    assert confidence == 0.0